@@ -0,0 +1,259 @@
+'''
+Benchmarks for cit.
+
+Measures the startup time of cit, and how commands scale with the number of jobs in the server:
+each command is executed against a fake Jenkins server (see fake_jenkins.py) with different numbers
+of jobs, recording its wall time, the number of HTTP requests, bytes transferred and peak memory.
+
+Results are printed and saved as JSON, so they can be compared between revisions to spot
+performance regressions.
+
+Usage::
+    python bench_cit.py [--repeat N] [--counts 10,1000,10000] [--latency MS] [--output bench_results.json]
+'''
+from __future__ import with_statement
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+    import json
+except ImportError:  # Python 2.5
+    import simplejson as json
+
+
+CIT_DIR = os.path.abspath(os.path.dirname(__file__))
+
+
+#===================================================================================================
+# time_process
+#===================================================================================================
+def time_process(args, repeat):
+    '''
+    Executes a process `repeat` times.
+
+    :return dict: minimum, median and maximum wall times in milliseconds.
+    '''
+    timings = []
+    devnull = file(os.devnull, 'w')
+    try:
+        for _ in xrange(repeat):
+            start = time.time()
+            # exit code is not checked: "cit --help" returns 1, for instance
+            subprocess.call(args, stdout=devnull, stderr=devnull, cwd=CIT_DIR)
+            timings.append((time.time() - start) * 1000.0)
+    finally:
+        devnull.close()
+
+    timings.sort()
+    return {
+        'min_ms' : round(timings[0], 1),
+        'median_ms' : round(timings[len(timings) // 2], 1),
+        'max_ms' : round(timings[-1], 1),
+    }
+
+
+#===================================================================================================
+# bench_startup
+#===================================================================================================
+def bench_startup(repeat):
+    '''
+    Measures the startup time of cit: importing the module, and executing "cit --help".
+    '''
+    cit_script = os.path.join(CIT_DIR, 'cit.py')
+    return {
+        'python' : time_process([sys.executable, '-c', 'pass'], repeat),
+        'import' : time_process([sys.executable, '-c', 'import cit'], repeat),
+        'help' : time_process([sys.executable, cit_script, '--help'], repeat),
+    }
+
+
+#===================================================================================================
+# run_process
+#===================================================================================================
+def run_process(args, stdin_data='', cwd=None, env=None):
+    '''
+    Executes a process, feeding it the given input.
+
+    :return dict:
+        The wall time in milliseconds, exit code and peak memory (resident set size, in KB) of the
+        process; the peak memory is None on platforms that can't measure it.
+    '''
+    devnull = file(os.devnull, 'w')
+    try:
+        start = time.time()
+        process = subprocess.Popen(
+            args, stdin=subprocess.PIPE, stdout=devnull, stderr=devnull, cwd=cwd, env=env)
+        process.stdin.write(stdin_data)
+        process.stdin.close()
+        if hasattr(os, 'wait4'):
+            status, rusage = os.wait4(process.pid, 0)[1:]
+            # so Popen doesn't try to wait for it again
+            process.returncode = os.WEXITSTATUS(status)
+            peak_memory = rusage.ru_maxrss
+        else:
+            process.wait()
+            peak_memory = None
+        elapsed = (time.time() - start) * 1000.0
+    finally:
+        devnull.close()
+
+    return {
+        'wall_ms' : round(elapsed, 1),
+        'exit_code' : process.returncode,
+        'peak_memory_kb' : peak_memory,
+    }
+
+
+#===================================================================================================
+# bench_commands
+#===================================================================================================
+BENCH_BRANCH = 'bench-branch'
+
+def bench_commands(job_count, latency, repeat):
+    '''
+    Executes cit commands against a fake Jenkins server with `job_count` jobs.
+
+    A copy of cit.py in a scratch directory is executed, so the files cit keeps next to it
+    (citconfig.yaml, cittrackjobs.yaml and caches) don't affect (or get changed by) the benchmark.
+    The job list cache is disabled, so every execution queries the server.
+
+    :param float latency:
+        Seconds each request takes to be answered by the server.
+
+    :param int repeat:
+        Executions of each command; the server is restored to its initial state before each one.
+
+    :return dict:
+        For each command, the minimum, median and maximum wall times (in milliseconds), and the
+        requests, bytes transferred, peak memory and exit code of its last execution.
+    '''
+    from fake_jenkins import FakeJenkins
+
+    config = file(os.path.join(CIT_DIR, 'test_config.xml')).read()
+    work_dir = tempfile.mkdtemp(prefix='bench_cit')
+    fake_jenkins = FakeJenkins(latency=latency)
+    fake_jenkins.start()
+    try:
+        # cit and its configuration
+        shutil.copy(os.path.join(CIT_DIR, 'cit.py'), work_dir)
+        cit_script = os.path.join(work_dir, 'cit.py')
+        f = file(os.path.join(work_dir, 'citconfig.yaml'), 'w')
+        f.write('jenkins:\n  url: %s\n  user: bench\n  pass: bench\n  cache-ttl: 0\n' % fake_jenkins.url)
+        f.close()
+
+        # a repository with feature branch jobs configured (and an user, so git isn't needed)
+        repo_dir = os.path.join(work_dir, 'repo')
+        os.makedirs(os.path.join(repo_dir, '.git'))
+        f = file(os.path.join(repo_dir, '.git', 'config'), 'w')
+        f.write('[user]\n\tname = bench\n\temail = bench@example.com\n')
+        f.close()
+        f = file(os.path.join(repo_dir, '.cit.yaml'), 'w')
+        f.write('jobs:\n')
+        for suffix in ('win32', 'linux64'):
+            f.write('- source-job: project_master_%s\n' % suffix)
+            f.write('  feature-branch-job: project_$name_%s\n' % suffix)
+        f.close()
+
+        # configuration files changed just now are not cached by cit (see load_config_file): make
+        # them older, as in an usual installation
+        old_time = time.time() - 3600
+        for filename in ('citconfig.yaml', os.path.join('repo', '.cit.yaml')):
+            os.utime(os.path.join(work_dir, filename), (old_time, old_time))
+
+        env = dict(os.environ)
+        # dependencies that are submodules of the original installation
+        submodule_dirs = [
+            os.path.join(CIT_DIR, name) for name in (os.path.join('pyyaml', 'lib'), 'clik')]
+        env['PYTHONPATH'] = os.pathsep.join(submodule_dirs + [env.get('PYTHONPATH', '')])
+        env['CIT_NO_DAEMON'] = '1'
+        env.pop('CIT_CONFIG', None)
+
+        # jobs: sources of the feature branch jobs, and many others
+        initial_jobs = ['project_master_win32', 'project_master_linux64']
+        initial_jobs += ['project_%05d' % i for i in xrange(job_count - len(initial_jobs))]
+
+        def reset_jobs():
+            fake_jenkins.jobs.clear()
+            for job_name in initial_jobs:
+                fake_jenkins.add_job(job_name, config, builds=1)
+
+        jobs_dir = os.path.join(work_dir, 'jobs')
+        commands = [
+            ('fb.add', ['fb.add', BENCH_BRANCH], '', repo_dir),
+            ('fb.start', ['fb.start', BENCH_BRANCH], '', repo_dir),
+            ('sv.ls', ['sv.ls', 'project_*'], '', work_dir),
+            ('sv.st', ['sv.st', 'project_*'], 'e\n', work_dir),
+            ('sv.down', ['sv.down', 'project_*', jobs_dir, '--jobs', '8'], 'y\n', work_dir),
+            ('sv.up', ['sv.up', jobs_dir, '--jobs', '8'], 'y\n', work_dir),
+        ]
+
+        results = {}
+        for name, argv, stdin_data, cwd in commands:
+            timings = []
+            for _ in xrange(repeat):
+                reset_jobs()
+                if name == 'fb.start':
+                    for suffix in ('win32', 'linux64'):
+                        fake_jenkins.add_job('project_%s_%s' % (BENCH_BRANCH, suffix), config)
+                fake_jenkins.reset_stats()
+                result = run_process([sys.executable, cit_script] + argv, stdin_data, cwd, env)
+                timings.append(result.pop('wall_ms'))
+            timings.sort()
+            result.update({
+                'min_ms' : timings[0],
+                'median_ms' : timings[len(timings) // 2],
+                'max_ms' : timings[-1],
+                'requests' : len(fake_jenkins.requests),
+                'bytes_sent' : fake_jenkins.bytes_sent,
+                'bytes_received' : fake_jenkins.bytes_received,
+            })
+            results[name] = result
+        return results
+    finally:
+        fake_jenkins.stop()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+#===================================================================================================
+# main
+#===================================================================================================
+def main(argv):
+    from optparse import OptionParser
+
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--repeat', type='int', default=10, help='executions of each startup benchmark')
+    parser.add_option('--command-repeat', type='int', default=3,
+        help='executions of each command benchmark')
+    parser.add_option('--counts', default='10,1000,10000',
+        help='comma separated numbers of jobs in the server (default: %default)')
+    parser.add_option('--latency', type='float', default=0,
+        help='milliseconds each request takes to be answered by the server (default: %default)')
+    parser.add_option('--output', default='bench_results.json', help='JSON file with the results')
+    opts, args = parser.parse_args(argv)
+
+    job_counts = [int(count) for count in opts.counts.split(',') if count.strip()]
+    commands = {'latency_ms' : opts.latency}
+    for job_count in job_counts:
+        commands[str(job_count)] = bench_commands(
+            job_count, opts.latency / 1000.0, opts.command_repeat)
+
+    results = {
+        'python_version' : sys.version.split()[0],
+        'startup' : bench_startup(opts.repeat),
+        'commands' : commands,
+    }
+
+    print json.dumps(results, indent=2, sort_keys=True)
+    f = file(opts.output, 'w')
+    try:
+        json.dump(results, f, indent=2, sort_keys=True)
+    finally:
+        f.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -14,7 +14,6 @@ def configure_submodules_path():
     import sys, os
 
     directory = os.path.abspath(os.path.dirname(__file__))
-    sys.path.insert(0, os.path.join(directory, 'jenkinsapi'))
     sys.path.insert(0, os.path.join(directory, 'pyyaml', 'lib'))
     sys.path.insert(0, os.path.join(directory, 'clik'))
 
@@ -23,234 +22,2101 @@ configure_submodules_path()
 #===================================================================================================
 # imports
 #===================================================================================================
-from jenkinsapi.custom_exceptions import UnknownJob
-from jenkinsapi.jenkins import Jenkins
 import contextlib
 import subprocess
-import xml.etree.ElementTree as ET
-import yaml
 import os
 import sys
-import urllib2
 import glob
 import re
+import StringIO
 import time
+import base64
+import copy
+import cProfile
+import csv
+import errno
+import fnmatch
+import hashlib
+import marshal
+import Queue
+import random
+import shlex
 import clik
 from optparse import make_option as opt
 
+try:
+    import json
+except ImportError:  # Python 2.5
+    import simplejson as json
+
+#===================================================================================================
+# clik initialization
+#
+# This block is used to initialize clik framework
+#
+#===================================================================================================
+
+#===================================================================================================
+# get_global_config_file
+#===================================================================================================
+def get_global_config_file():
+    '''
+    Returns the path to the global config file.
+    '''
+    # default values
+    global_config_file = os.environ.get('CIT_CONFIG')
+    if global_config_file is None:
+        global_config_file = os.path.join(os.path.dirname(__file__), 'citconfig.yaml')
+    return global_config_file
+
+
+#===================================================================================================
+# get_job_index_cache_file
+#===================================================================================================
+DEFAULT_CACHE_TTL = 60
+
+def get_job_index_cache_file():
+    '''
+    Returns the path to the file where the job index of the server is cached, which lives
+    alongside the global config file.
+
+    How long (in seconds) the cached index is used can be configured with "cache-ttl" under
+    "jenkins" in the global config file (0 disables the cache).
+    '''
+    return os.path.join(os.path.dirname(get_global_config_file()), 'citjobs.cache')
+
+
+#===================================================================================================
+# get_command_args
+#===================================================================================================
+def get_command_args(argv, app, opts=None):
+    '''
+    Returns a dict containing all extra options that commands in this module can receive as
+    arguments.
+
+    Only the options the command being executed actually receives are computed, so commands don't
+    pay for git queries or configuration files they don't use.
+
+    Tracing and profiling (global options "--trace" and "--profile") start here, so they also
+    cover obtaining these options.
+
+    See clik framework for more details on this.
+    '''
+    import inspect
+
+    if opts is not None:
+        start_tracing(opts.trace, opts.profile)
+
+    command_function = get_command_function(app, argv)
+    arg_names = inspect.getargspec(command_function)[0]
+
+    result = {}
+    with trace_phase('config'):
+        if 'job_config' in arg_names:
+            cit_file_name, result['job_config'] = load_cit_local_config(os.getcwd())
+
+        if 'global_config' in arg_names:
+            result['global_config'] = load_global_config()
+
+    with trace_phase('git'):
+        if 'user_name' in arg_names or 'user_email' in arg_names:
+            result['user_name'], result['user_email'] = get_git_user()
+
+        if 'branch' in arg_names:
+            result['branch'] = get_git_branch()
+
+    return result
+
+
+#===================================================================================================
+# get_command_function
+#===================================================================================================
+def get_command_function(app, argv):
+    '''
+    Returns the function of the command given in the command line (the first argument that is not
+    an option), as clik does.
+    '''
+    command_names = [name for name in argv if not name.startswith('-')]
+    if command_names:
+        for function, command in app.commands.iteritems():
+            if command_names[0] in command['names']:
+                return function
+    return None
+
+
+#===================================================================================================
+# load_global_config
+#===================================================================================================
+def load_global_config():
+    '''
+    :return dict: the contents of the global config file, empty if there's no such file.
+    '''
+    global_config_file = get_global_config_file()
+    if os.path.isfile(global_config_file):
+        return load_config_file(global_config_file, GLOBAL_CONFIG_SCHEMA)
+    return {}
+
+
+#===================================================================================================
+# ConfigError
+#===================================================================================================
+class ConfigError(Exception):
+    '''
+    Raised when a configuration file is not valid.
+    '''
+
+
+#===================================================================================================
+# config schemas
+#===================================================================================================
+# each schema is either a type (or tuple of types), a list with the schema of its items, or a dict
+# mapping keys to (schema, required); unknown keys are accepted, and None is accepted for optional
+# keys, as they are written by "key:" in YAML.
+_NUMBER = (int, long, float)
+
+GLOBAL_CONFIG_SCHEMA = {
+    'jenkins' : ({
+        'url' : (basestring, True),
+        'user' : ((basestring, int, long), False),
+        'pass' : ((basestring, int, long), False),
+        'cache-ttl' : (_NUMBER, False),
+        'connect-timeout' : (_NUMBER, False),
+        'read-timeout' : (_NUMBER, False),
+        'retries' : ((int, long), False),
+        'retry-budget' : ((int, long), False),
+    }, True),
+}
+
+LOCAL_CONFIG_SCHEMA = {
+    'jobs' : ([{
+        'source-job' : (basestring, True),
+        'feature-branch-job' : (basestring, True),
+    }], False),
+}
+
+TRACK_JOBS_SCHEMA = {
+    'pattern' : (basestring, True),
+    'jobs' : ([basestring], False),
+}
+
+
+#===================================================================================================
+# validate_config
+#===================================================================================================
+def validate_config(config, schema, path='config'):
+    '''
+    Checks that the given configuration matches a schema (see GLOBAL_CONFIG_SCHEMA).
+
+    :raise ConfigError: describing the first entry that doesn't match.
+    '''
+    if isinstance(schema, dict):
+        if not isinstance(config, dict):
+            raise ConfigError('%s: expected a mapping' % path)
+        for key, (value_schema, required) in sorted(schema.iteritems()):
+            value = config.get(key)
+            if value is None:
+                if required:
+                    raise ConfigError('%s: missing "%s"' % (path, key))
+            else:
+                validate_config(value, value_schema, '%s.%s' % (path, key))
+
+    elif isinstance(schema, list):
+        if not isinstance(config, list):
+            raise ConfigError('%s: expected a list' % path)
+        for index, item in enumerate(config):
+            validate_config(item, schema[0], '%s[%d]' % (path, index))
+
+    else:
+        types = schema if isinstance(schema, tuple) else (schema,)
+        # bool is a subclass of int, but "true" is not a valid number
+        if not isinstance(config, types) or (isinstance(config, bool) and bool not in types):
+            raise ConfigError('%s: invalid value %r' % (path, config))
+
+
+#===================================================================================================
+# load_config_file
+#===================================================================================================
+_loaded_configs = {}
+
+def load_config_file(filename, schema):
+    '''
+    Loads and validates a YAML configuration file.
+
+    Parsing YAML is slow for big files (such as .cit.yaml with many jobs), so the parsed and
+    validated contents are kept in a cache file (see get_config_cache_file), and reused for as long
+    as the modification time and size of the file don't change.
+
+    An empty file results in an empty dict.
+
+    Long running processes (see cit_serve) also keep the contents in memory.
+
+    :raise ConfigError: if the contents don't match the given schema.
+    '''
+    filename = os.path.abspath(filename)
+    stat = os.stat(filename)
+    signature = (stat.st_mtime, stat.st_size)
+
+    loaded = _loaded_configs.get(filename)
+    if loaded is not None and loaded[0] == signature:
+        # a new copy every time, since callers may change the returned config
+        return marshal.loads(loaded[1])
+
+    cache_file = get_config_cache_file()
+    try:
+        cache = marshal.loads(file(cache_file, 'rb').read())
+        if cache.get('version') != sys.version:
+            cache = {}
+    except (IOError, EOFError, ValueError, TypeError, AttributeError):
+        cache = {}
+
+    entry = cache.get(filename)
+    if entry is not None and entry[0] == signature:
+        _loaded_configs[filename] = (signature, marshal.dumps(entry[1]))
+        return entry[1]
+
+    import yaml
+    loader = getattr(yaml, 'CLoader', yaml.Loader)
+    try:
+        config = yaml.load(file(filename).read(), Loader=loader) or {}
+    except yaml.YAMLError, e:
+        raise ConfigError('%s: %s' % (filename, e))
+    validate_config(config, schema, os.path.basename(filename))
+
+    # a file changed right after being cached could keep its modification time and size, so only
+    # files that have not been modified for a while are cached
+    if time.time() - stat.st_mtime > 2:
+        try:
+            cache['version'] = sys.version
+            cache[filename] = (signature, config)
+            contents = marshal.dumps(cache)
+        except ValueError:
+            # values that can't be cached (such as dates); they are parsed every time
+            pass
+        else:
+            _loaded_configs[filename] = (signature, marshal.dumps(config))
+            # write to a temporary file first so concurrent invocations never read a partial cache
+            temp_filename = '%s.%d' % (cache_file, os.getpid())
+            try:
+                f = file(temp_filename, 'wb')
+                try:
+                    f.write(contents)
+                finally:
+                    f.close()
+                if os.path.isfile(cache_file):
+                    os.remove(cache_file)
+                os.rename(temp_filename, cache_file)
+            except (IOError, OSError):
+                # the cache is just an optimization
+                pass
+
+    return config
+
+
+#===================================================================================================
+# get_config_cache_file
+#===================================================================================================
+def get_config_cache_file():
+    '''
+    Returns the path to the file where parsed configuration files are cached, which lives alongside
+    the global config file.
+    '''
+    return os.path.join(os.path.dirname(get_global_config_file()), 'citconfig.cache')
+
+
+app = clik.App(
+    name='cit',
+    description='Command line tool for interacting with a Jenkins integration server.\n',
+    args_callback=get_command_args,
+    shell_command=False,
+    console_opts=False,
+    opts=[
+        opt('--trace', default=False, action='store_true',
+            help='show HTTP requests and subprocesses, and where the time was spent'),
+        opt('--profile', metavar='FILE', help='write cProfile statistics of the command to FILE'),
+    ],
+)
+
+#===================================================================================================
+# Jenkins Client
+# --------------
+#
+# Lean client for the parts of the Jenkins remote API used by cit. It mimics the interface of
+# jenkinsapi's objects used by the commands, but differently from them nothing is fetched from the
+# server up-front: each operation issues only the requests it needs, and every query filters the
+# returned data with "tree=".
+#
+#===================================================================================================
+
+#===================================================================================================
+# UnknownJob
+#===================================================================================================
+class UnknownJob(KeyError):
+    '''
+    Raised when a job does not exist in the Jenkins server.
+    '''
+
+
+#===================================================================================================
+# NoBuildData
+#===================================================================================================
+class NoBuildData(KeyError):
+    '''
+    Raised when a job has no builds yet.
+    '''
+
+
+#===================================================================================================
+# JenkinsClient
+#===================================================================================================
+# size of the blocks in which large responses are read
+CHUNK_SIZE = 64 * 1024
+
+class JenkinsClient(object):
+
+    JOB_INDEX_TREE = 'jobs[name,color,lastBuild[number,result,timestamp,building]]'
+
+    def __init__(self, baseurl, username=None, password=None, job_index_cache=None,
+        transport=None):
+        '''
+        :param JobIndexCache job_index_cache:
+            If given, the job index is shared through it with other cit invocations.
+
+        :param HttpTransport transport:
+            Transport used for all requests; by default one with default settings is created.
+        '''
+        self.baseurl = baseurl.rstrip('/')
+        self.username = username
+        self.password = password
+        self.job_index_cache = job_index_cache
+        self.transport = transport or HttpTransport()
+        self._job_index = None
+
+    def request(self, url, data=None, params=None, content_type=None, stream=False):
+        '''
+        Performs a request to the server.
+
+        :param str data:
+            Body of the request; when given (even if empty) the request is a POST.
+
+        :param dict params:
+            Parameters added to the url query.
+
+        :param bool stream:
+            See HttpTransport.request.
+
+        :rtype: HttpResponse
+        '''
+        import urllib
+
+        if params:
+            url += '?' + urllib.urlencode(params)
+        headers = {}
+        if self.username:
+            credentials = '%s:%s' % (self.username, self.password)
+            headers['Authorization'] = 'Basic ' + base64.b64encode(credentials)
+        if content_type:
+            headers['Content-Type'] = content_type
+        method = 'GET' if data is None else 'POST'
+        return self.transport.request(method, url, data, headers, stream)
+
+    def get_json(self, url, tree):
+        '''
+        Queries the "api/json" of the given url, returning only the data selected by `tree`.
+        '''
+        response = self.request(url + '/api/json', params={'tree' : tree})
+        try:
+            return json.load(response)
+        finally:
+            response.close()
+
+    def post(self, url, data='', params=None, content_type=None):
+        self.request(url, data, params, content_type).close()
+
+    def get_job_url(self, job_name):
+        import urllib
+
+        return '%s/job/%s' % (self.baseurl, urllib.quote(job_name, safe=''))
+
+    def keys(self):
+        '''
+        :return list(str): names of all jobs in the server.
+        '''
+        return [job['name'] for job in self.get_json(self.baseurl, 'jobs[name]')['jobs']]
+
+    def iterkeys(self):
+        return iter(self.keys())
+
+    def get_job_index(self, refresh=False):
+        '''
+        Obtains the status of all jobs in the server with a single request.
+
+        The index is kept in memory (and in the job index cache, if any) until a job is created,
+        renamed or deleted through this client.
+
+        :param bool refresh:
+            Ignore previously obtained indexes and query the server.
+
+        :rtype: list(dict)
+        :return:
+            An entry for each job with its "name", "color" and "lastBuild"; "lastBuild" is None
+            when the job was never built, otherwise a dict with its "number", "result",
+            "timestamp" and "building" flag.
+        '''
+        with trace_phase('job index'):
+            if not refresh:
+                if self._job_index is None and self.job_index_cache is not None:
+                    self._job_index = self.job_index_cache.load(self.baseurl)
+                if self._job_index is not None:
+                    return self._job_index
+
+            self._job_index = self.get_json(self.baseurl, self.JOB_INDEX_TREE)['jobs']
+            if self.job_index_cache is not None:
+                self.job_index_cache.save(self.baseurl, self._job_index)
+            return self._job_index
+
+    def invalidate_job_index(self):
+        self._job_index = None
+        if self.job_index_cache is not None:
+            self.job_index_cache.invalidate()
+
+    def has_job(self, job_name):
+        import urllib2
+
+        try:
+            self.get_json(self.get_job_url(job_name), 'name')
+        except urllib2.HTTPError, e:
+            if e.code == 404:
+                return False
+            raise
+        return True
+
+    def get_job(self, job_name):
+        '''
+        :raise UnknownJob: if there's no job with the given name.
+        '''
+        if not self.has_job(job_name):
+            raise UnknownJob(job_name)
+        return JenkinsJob(self, job_name)
+
+    def create_job(self, job_name, config_xml):
+        self.invalidate_job_index()
+        self.post(self.baseurl + '/createItem', config_xml, params={'name' : job_name},
+            content_type='application/xml')
+        return JenkinsJob(self, job_name)
+
+    def copy_job(self, job_name, new_job_name):
+        self.invalidate_job_index()
+        self.post(self.baseurl + '/createItem',
+            params={'name' : new_job_name, 'mode' : 'copy', 'from' : job_name})
+        return JenkinsJob(self, new_job_name)
+
+    def rename_job(self, job_name, new_job_name):
+        self.invalidate_job_index()
+        self.post(self.get_job_url(job_name) + '/doRename', params={'newName' : new_job_name})
+        return JenkinsJob(self, new_job_name)
+
+    def delete_job(self, job_name):
+        self.invalidate_job_index()
+        self.post(self.get_job_url(job_name) + '/doDelete')
+
+
+#===================================================================================================
+# JenkinsJob
+#===================================================================================================
+class JenkinsJob(object):
+    '''
+    A job in the Jenkins server; no request is made until one of its methods is called.
+    '''
+
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+        self.url = client.get_job_url(name)
+
+    def __str__(self):
+        return self.name
+
+    def get_config(self):
+        response = self.client.request(self.url + '/config.xml')
+        try:
+            return response.read()
+        finally:
+            response.close()
+
+    def download_config(self, stream):
+        '''
+        Writes the job configuration to the given file-like object as it is received, without
+        holding the whole document in memory.
+        '''
+        response = self.client.request(self.url + '/config.xml', stream=True)
+        try:
+            while True:
+                chunk = response.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                stream.write(chunk)
+        finally:
+            response.close()
+
+    def update_config(self, config_xml):
+        self.client.invalidate_job_index()
+        self.client.post(self.url + '/config.xml', config_xml, content_type='application/xml')
+
+    def enable(self):
+        self.client.invalidate_job_index()
+        self.client.post(self.url + '/enable')
+
+    def disable(self):
+        self.client.invalidate_job_index()
+        self.client.post(self.url + '/disable')
+
+    def get_build_triggerurl(self):
+        return self.url + '/build', {}
+
+    def invoke(self, securitytoken=None):
+        '''
+        Schedules a build of the job; the job index is invalidated, since the job status changes.
+
+        :return str:
+            The url of the queue item of the build, or None if the server doesn't tell it.
+        '''
+        self.client.invalidate_job_index()
+        params = {}
+        if securitytoken:
+            params['token'] = securitytoken
+        response = self.client.request(self.url + '/build', '', params)
+        try:
+            queue_url = response.getheader('Location')
+        finally:
+            response.close()
+        if queue_url:
+            return queue_url.rstrip('/')
+        return None
+
+    def is_running(self):
+        last_build = self.client.get_json(self.url, 'lastBuild[building]')['lastBuild']
+        return bool(last_build and last_build['building'])
+
+    def get_last_build(self):
+        '''
+        :raise NoBuildData: if the job was never built.
+        '''
+        import urllib2
+
+        try:
+            data = self.client.get_json(
+                self.url + '/lastBuild', 'number,result,timestamp,building')
+        except urllib2.HTTPError, e:
+            if e.code == 404:
+                raise NoBuildData(self.name)
+            raise
+        return JenkinsBuild(data)
+
+    def get_build(self, number):
+        data = self.client.get_json(
+            '%s/%d' % (self.url, number), 'number,result,timestamp,building')
+        return JenkinsBuild(data)
+
+    def read_log(self, number, start, stream):
+        '''
+        Writes the console output of a build to the given file-like object as it is received,
+        starting at the given byte offset, so only output not yet obtained is transferred.
+
+        :return tuple(int, bool):
+            The offset where the next read should start, and whether there may be more output (the
+            build is still running).
+        '''
+        response = self.client.request(
+            '%s/%d/logText/progressiveText' % (self.url, number), params={'start' : start},
+            stream=True)
+        try:
+            while True:
+                chunk = response.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                start += len(chunk)
+                stream.write(chunk)
+            next_start = int(response.getheader('X-Text-Size', start))
+            more_data = response.getheader('X-More-Data', '').lower() == 'true'
+        finally:
+            response.close()
+        return next_start, more_data
+
+
+#===================================================================================================
+# JenkinsBuild
+#===================================================================================================
+class JenkinsBuild(object):
+
+    def __init__(self, data):
+        self.data = data
+
+    def get_number(self):
+        return self.data['number']
+
+    def is_running(self):
+        return self.data['building']
+
+    def get_status(self):
+        return self.data['result']
+
+    def get_timestamp(self):
+        '''
+        :return int: the number of milliseconds since January 1, 1970, 00:00:00 GMT.
+        '''
+        return self.data['timestamp']
+
+
+#===================================================================================================
+# HttpTransport
+#===================================================================================================
+class HttpTransport(object):
+    '''
+    Performs the HTTP requests of a cit invocation, with connect and read timeouts and retrying
+    failed requests with an exponential backoff.
+
+    Connections are kept alive and reused by subsequent requests to the same server, including
+    requests made from other threads. Proxies configured in the environment are honored: HTTP
+    requests are sent to the proxy, and HTTPS connections are tunneled through it.
+
+    Requests are retried when the server can't be reached or answers with a transient error
+    (502, 503 or 504); requests that may change something in the server (POST) are only retried
+    when it is known they were not processed. A GET sent through a kept alive connection that the
+    server had already closed is sent again through a new connection. All requests share a budget
+    of retries, so a server that is down doesn't make a command retry every single request.
+    '''
+
+    MAX_IDLE_CONNECTIONS = 10
+    RETRY_STATUSES = (502, 503, 504)
+    REDIRECT_STATUSES = (301, 302, 303, 307)
+    MAX_REDIRECTS = 5
+    STALE_CONNECTION_ERRNOS = (errno.ECONNRESET, errno.EPIPE)
+
+    def __init__(self, connect_timeout=10, read_timeout=60, retries=3, retry_budget=20,
+        backoff=0.5, max_backoff=10, proxies=None):
+        '''
+        :param float connect_timeout:
+            Seconds to wait for a connection to be established.
+
+        :param float read_timeout:
+            Seconds to wait for data from the server once connected.
+
+        :param int retries:
+            Maximum number of retries for each request.
+
+        :param int retry_budget:
+            Maximum number of retries for all requests made through this transport (until
+            reset_retry_budget is called).
+
+        :param float backoff:
+            Base delay (in seconds) before a retry, doubled on each new attempt (up to
+            `max_backoff`); the actual delay is randomized between 0 and that value so concurrent
+            requests don't retry all at once.
+
+        :param dict(str, str) proxies:
+            Maps url schemes ("http", "https") to the url of the proxy used to reach servers with
+            that scheme (possibly with the user and password to authenticate with it); by default
+            obtained from the environment ("http_proxy", "https_proxy"). Servers listed in
+            "no_proxy" are always reached directly.
+        '''
+        import urllib
+
+        if proxies is None:
+            proxies = urllib.getproxies()
+        self.proxies = proxies
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retries = retries
+        self.initial_retry_budget = retry_budget
+        self.retry_budget = retry_budget
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.requests = 0
+        self.connections_opened = 0
+        self.connections_reused = 0
+        self._idle_connections = {}
+        self._lock = threading.Lock()
+
+    def request(self, method, url, body=None, headers=None, stream=False):
+        '''
+        :param bool stream:
+            If False the whole response body is read (and retried, if necessary) before returning;
+            otherwise it should be read from the returned response as needed.
+
+        :rtype: HttpResponse
+
+        :raise urllib2.HTTPError:
+            If the server answers with an error status.
+
+        :raise urllib2.URLError:
+            If the server can't be reached.
+        '''
+        import httplib
+        import socket
+        import urllib2
+        import urlparse
+
+        headers = headers or {}
+        redirects = 0
+        attempt = 0
+        reuse = True
+        while True:
+            try:
+                connection, reused = self._connect(url, reuse)
+            except (socket.error, httplib.HTTPException), e:
+                error = urllib2.URLError(e)
+                retry = True
+            else:
+                try:
+                    response = self._send(connection, method, url, body, headers, stream)
+                except (socket.error, httplib.HTTPException), e:
+                    connection.close()
+                    if reused and method == 'GET' and self._is_stale_connection_error(e):
+                        # the server closed the idle connection: try again with a new one
+                        reuse = False
+                        continue
+                    error = urllib2.URLError(e)
+                    # the request might have been processed by the server
+                    retry = method == 'GET'
+                else:
+                    status = response.status
+                    if method == 'GET' and status in self.REDIRECT_STATUSES and \
+                        redirects < self.MAX_REDIRECTS:
+                        response.close()
+                        url = urlparse.urljoin(url, response.getheader('location'))
+                        redirects += 1
+                        continue
+
+                    if status < 400:
+                        return response
+
+                    try:
+                        error_body = response.read()
+                    finally:
+                        response.close()
+                    error = urllib2.HTTPError(
+                        url, status, response.reason, response.msg, StringIO.StringIO(error_body))
+                    # 503 means the server is not processing requests (starting up, for instance)
+                    retry = status == 503 or (method == 'GET' and status in self.RETRY_STATUSES)
+
+            if not retry or attempt >= self.retries or not self._spend_retry():
+                raise error
+
+            delay = min(self.max_backoff, self.backoff * (2 ** attempt))
+            time.sleep(random.uniform(0, delay))
+            attempt += 1
+
+    def get_stats(self):
+        '''
+        :return dict:
+            Number of "requests" made, and of connections "opened" and "reused" to make them.
+        '''
+        with self._lock:
+            return {
+                'requests' : self.requests,
+                'opened' : self.connections_opened,
+                'reused' : self.connections_reused,
+            }
+
+    def close(self):
+        '''
+        Closes all idle connections.
+        '''
+        with self._lock:
+            idle_connections, self._idle_connections = self._idle_connections, {}
+        for connections in idle_connections.itervalues():
+            for connection in connections:
+                connection.close()
+
+    @classmethod
+    def _is_stale_connection_error(cls, error):
+        '''
+        :return bool:
+            If the error means a reused connection had already been closed by the server, before
+            any byte of the response was received (timeouts don't, the server might be processing
+            the request).
+        '''
+        import httplib
+        import socket
+
+        if isinstance(error, socket.timeout):
+            return False
+        if isinstance(error, httplib.BadStatusLine):
+            return True
+        return isinstance(error, socket.error) and error.errno in cls.STALE_CONNECTION_ERRNOS
+
+    def reset_retry_budget(self):
+        '''
+        Makes the whole budget of retries available again, for transports used by many commands
+        (see run_batch_command).
+        '''
+        with self._lock:
+            self.retry_budget = self.initial_retry_budget
+
+    def _spend_retry(self):
+        '''
+        :return bool: if there was still a retry available in the budget (which is consumed).
+        '''
+        with self._lock:
+            if self.retry_budget <= 0:
+                return False
+            self.retry_budget -= 1
+            return True
+
+    def _connect(self, url, reuse=True):
+        '''
+        :return tuple(httplib.HTTPConnection, bool):
+            A connection to the server of the given url, and if it is an idle connection being
+            reused.
+        '''
+        import httplib
+        import urlparse
+
+        parts = urlparse.urlsplit(url)
+        key = (parts.scheme, parts.hostname, parts.port)
+        with self._lock:
+            self.requests += 1
+            idle_connections = self._idle_connections.get(key)
+            if reuse and idle_connections:
+                self.connections_reused += 1
+                return idle_connections.pop(), True
+            self.connections_opened += 1
+
+        if parts.scheme == 'https':
+            connection_class = httplib.HTTPSConnection
+        else:
+            connection_class = httplib.HTTPConnection
+        proxy = self._get_proxy(parts)
+        if proxy is None:
+            connection = connection_class(parts.hostname, parts.port, timeout=self.connect_timeout)
+            connection.proxy_headers = None
+        else:
+            proxy_host, proxy_port, proxy_headers = proxy
+            connection = connection_class(proxy_host, proxy_port, timeout=self.connect_timeout)
+            if parts.scheme == 'https':
+                # the proxy only relays the encrypted connection to the server (CONNECT)
+                if hasattr(connection, 'set_tunnel'):
+                    connection.set_tunnel(parts.hostname, parts.port, proxy_headers)
+                else:
+                    # Python 2.6 can't send headers to the proxy when tunneling
+                    connection._set_tunnel(parts.hostname, parts.port)
+                connection.proxy_headers = None
+            else:
+                connection.proxy_headers = proxy_headers
+        connection.connect()
+        connection.sock.settimeout(self.read_timeout)
+        connection.pool_key = key
+        return connection, False
+
+    def _get_proxy(self, parts):
+        '''
+        :param parts:
+            The url of the server, as split by urlparse.urlsplit.
+
+        :return tuple(str, int, dict):
+            The host and port of the proxy used to reach the server, and the headers that
+            authenticate with it; None if the server is reached directly.
+        '''
+        import urllib
+        import urlparse
+
+        proxy_url = self.proxies.get(parts.scheme)
+        if not proxy_url or urllib.proxy_bypass(parts.hostname):
+            return None
+        if '://' not in proxy_url:
+            proxy_url = 'http://' + proxy_url
+        proxy_parts = urlparse.urlsplit(proxy_url)
+        headers = {}
+        if proxy_parts.username is not None:
+            credentials = '%s:%s' % (
+                urllib.unquote(proxy_parts.username), urllib.unquote(proxy_parts.password or ''))
+            headers['Proxy-Authorization'] = 'Basic ' + base64.b64encode(credentials)
+        return proxy_parts.hostname, proxy_parts.port, headers
+
+    def _release(self, connection, response):
+        '''
+        Returns a connection to the pool once its response is fully read, so it can be reused by
+        other requests (from any thread).
+        '''
+        if response.will_close or not response.isclosed():
+            connection.close()
+            return
+
+        with self._lock:
+            idle_connections = self._idle_connections.setdefault(connection.pool_key, [])
+            if len(idle_connections) < self.MAX_IDLE_CONNECTIONS:
+                idle_connections.append(connection)
+                return
+        connection.close()
+
+    def _send(self, connection, method, url, body, headers, stream):
+        import urlparse
+
+        parts = urlparse.urlsplit(url)
+        if connection.proxy_headers is not None:
+            # requests sent to an HTTP proxy have the whole url of the server
+            path = urlparse.urlunsplit(parts[:4] + ('',))
+            headers = dict(headers, **connection.proxy_headers)
+        else:
+            path = parts.path or '/'
+            if parts.query:
+                path += '?' + parts.query
+        start = time.time()
+        try:
+            connection.request(method, path, body, headers)
+            response = connection.getresponse()
+        except:
+            trace_request(method, url, None, 0, start)
+            raise
+        if stream:
+            def on_close():
+                self._release(connection, response)
+                trace_request(method, url, response.status, http_response.bytes_read, start)
+            http_response = HttpResponse(response, response, on_close)
+            return http_response
+        try:
+            data = response.read()
+        except:
+            connection.close()
+            trace_request(method, url, None, 0, start)
+            raise
+        self._release(connection, response)
+        trace_request(method, url, response.status, len(data), start)
+        return HttpResponse(response, StringIO.StringIO(data))
+
+
+#===================================================================================================
+# HttpResponse
+#===================================================================================================
+class HttpResponse(object):
+    '''
+    Response of a request made by HttpTransport.
+    '''
+
+    def __init__(self, response, body, on_close=None):
+        '''
+        :param httplib.HTTPResponse response:
+            The response, as received by httplib.
+
+        :param body:
+            File-like object with the body of the response.
+
+        :param callable on_close:
+            Called when the response is closed.
+        '''
+        self.status = response.status
+        self.reason = response.reason
+        self.msg = response.msg
+        self._body = body
+        self._on_close = on_close
+        self.bytes_read = 0
+
+    def getheader(self, name, default=None):
+        return self.msg.getheader(name, default)
+
+    def read(self, size=None):
+        if size is None or size < 0:
+            data = self._body.read()
+        else:
+            data = self._body.read(size)
+        self.bytes_read += len(data)
+        return data
+
+    def close(self):
+        # on_close needs to know if the body was fully read, so it goes first
+        if self._on_close is not None:
+            self._on_close()
+            self._on_close = None
+        self._body.close()
+
+
+#===================================================================================================
+# JobIndexCache
+#===================================================================================================
+class JobIndexCache(object):
+    '''
+    Persists the job index (see JenkinsClient.get_job_index) on disk, so subsequent cit invocations
+    can reuse it for `ttl` seconds instead of querying the server again.
+    '''
+
+    def __init__(self, filename, ttl):
+        self.filename = filename
+        self.ttl = ttl
+        self._signature = None
+
+    def load(self, url):
+        '''
+        :return list(dict):
+            The cached job index of the server at `url`, or None if there's no (fresh) index.
+        '''
+        try:
+            contents = json.load(file(self.filename))
+        except (IOError, ValueError):
+            return None
+
+        age = time.time() - contents.get('timestamp', 0)
+        if contents.get('url') != url or not 0 <= age < self.ttl:
+            return None
+        self._signature = self._get_signature()
+        return contents['jobs']
+
+    def save(self, url, job_index):
+        contents = {'url' : url, 'timestamp' : time.time(), 'jobs' : job_index}
+        # write to a temporary file first so concurrent invocations never read a partial index
+        temp_filename = '%s.%d' % (self.filename, os.getpid())
+        try:
+            f = file(temp_filename, 'w')
+            try:
+                json.dump(contents, f)
+            finally:
+                f.close()
+            self.invalidate()
+            os.rename(temp_filename, self.filename)
+            self._signature = self._get_signature()
+        except (IOError, OSError):
+            # the cache is just an optimization
+            pass
+
+    def is_current(self):
+        '''
+        :return bool:
+            Whether the index last loaded or saved is still the one in the cache file and has not
+            expired, so a process that keeps it in memory can go on using it. The index is not
+            current anymore when another cit invocation creates, renames or deletes a job.
+        '''
+        signature = self._get_signature()
+        return (
+            signature is not None and
+            signature == self._signature and
+            0 <= time.time() - signature[0] < self.ttl
+        )
+
+    def _get_signature(self):
+        try:
+            stat = os.stat(self.filename)
+        except OSError:
+            return None
+        return stat.st_mtime, stat.st_size
+
+    def invalidate(self):
+        if os.path.isfile(self.filename):
+            try:
+                os.remove(self.filename)
+            except OSError:
+                pass
+
+
+#===================================================================================================
+# Feature Branch Commands
+# -----------------------
+#
+# The next commands deal with feature branch jobs for the git repository in the current directory.
+#
+#===================================================================================================
+
+#===================================================================================================
+# create_feature_branch_job
+#===================================================================================================
+def create_feature_branch_job(jenkins, job_name, new_job_name, branch, user_email, stream=None,
+    source_configs=None):
+    '''
+    Creates (or updates) the job for a feature branch, using the given job as template. A job that
+    already has the resulting configuration is left untouched.
+
+    :param stream:
+        File-like object where progress is reported; defaults to sys.stdout.
+
+    :param SourceJobConfigs source_configs:
+        Configurations of source jobs already obtained, to be reused when creating jobs for many
+        branches.
+
+    :return str:
+        "CREATED", "UPDATED" or "UNCHANGED"; also reported in the first line written to `stream`.
+    '''
+    if stream is None:
+        stream = sys.stdout
+    import xml.etree.ElementTree as ET
+
+    if source_configs is None:
+        source_configs = SourceJobConfigs(jenkins)
+
+    tree = source_configs.get(job_name)
+
+    warnings = []
+    with trace_phase('xml'):
+        branch_elements = list(tree.findall('.//hudson.plugins.git.BranchSpec/name'))
+        if len(branch_elements) > 0:
+            branch_elements[0].text = branch
+        else:
+            warnings.append('Could not find any branch spec to replace!')
+
+        # If displayName exists adds the feature branch name to it.
+        display_name_elem = tree.find('./displayName')
+        if display_name_elem is not None:
+            display_name_elem.text = '%(branch_name)s %(display_name)s' % {'display_name':display_name_elem.text, 'branch_name':branch}
+
+        recipient_elements = list(tree.findall('.//hudson.tasks.Mailer/recipients'))
+        if len(recipient_elements) == 1:
+            recipient_element = recipient_elements[0]
+            recipient_element.text = user_email
+
+        # remove properties from the build so we can use "start" to start-up jobs
+        properties_elem = tree.find('./properties')
+        if properties_elem is not None:
+            for elem in properties_elem.findall('./hudson.model.ParametersDefinitionProperty'):
+                properties_elem.remove(elem)
+
+        # remove build triggers after this job
+        publishers_elem = tree.find('./publishers')
+        if publishers_elem is not None:
+            for elem in publishers_elem.findall('./hudson.tasks.BuildTrigger'):
+                publishers_elem.remove(elem)
+
+        config_xml = ET.tostring(tree)
+
+    try:
+        job = jenkins.get_job(new_job_name)
+    except UnknownJob:
+        status = 'CREATED'
+        job = jenkins.copy_job(job_name, new_job_name)
+    else:
+        # updating a job with the same configuration would only generate noise in the server
+        # (history of changes, SCM polling...)
+        if get_config_fingerprint(job.get_config()) == get_config_fingerprint(config_xml):
+            print >> stream, '%s => %s (UNCHANGED)' % (job_name, new_job_name)
+            return 'UNCHANGED'
+        status = 'UPDATED'
+
+    # this workaround is required otherwise when copying
+    # jobs using the remote-API they are created as
+    # non-buildable for some reason
+    job.disable()
+
+    print >> stream, '%s => %s (%s)' % (job_name, new_job_name, status)
+    for warning in warnings:
+        print >> stream, '  warning: %s' % warning
+
+    job.update_config(config_xml)
+
+    # part #2 of the workaround
+    job.enable()
+
+    return status
+
+
+#===================================================================================================
+# SourceJobConfigs
+#===================================================================================================
+class SourceJobConfigs(object):
+    '''
+    Parsed configurations of the source jobs of feature branch jobs, obtained from the server only
+    once no matter how many feature branch jobs are created from them.
+    '''
+
+    def __init__(self, jenkins):
+        self.jenkins = jenkins
+        self._trees = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def get(self, job_name):
+        '''
+        :rtype: ElementTree.Element
+        :return:
+            A copy of the configuration of the given job, which can be changed freely.
+        '''
+        import xml.etree.ElementTree as ET
+
+        # a lock per job, so concurrent requests for the same job wait for a single download
+        with self._lock:
+            job_lock = self._locks.setdefault(job_name, threading.Lock())
+
+        with job_lock:
+            if job_name not in self._trees:
+                config = self.jenkins.get_job(job_name).get_config()
+                self._trees[job_name] = ET.fromstring(config)
+        return copy.deepcopy(self._trees[job_name])
+
+
+#===================================================================================================
+# create_jenkins
+#===================================================================================================
+def create_jenkins(global_config, authenticate=False):
+    jenkins_url = global_config['jenkins']['url']
+    shared_client = None
+    if _shared_clients is not None:
+        shared_client = _shared_clients.get(jenkins_url)
+        # an authenticated client also serves commands that don't need authentication
+        if shared_client is not None and (shared_client.username is not None or not authenticate):
+            return shared_client
+
+    if authenticate:
+        try:
+            user_name = global_config['jenkins']['user']
+            password = global_config['jenkins']['pass']
+            assert user_name and password
+        except:
+            print "Note: 'user' and 'pass' can be specified in citconfig.yaml (under jenkins)"
+            user_name = raw_input('Username:')
+            password = getpass.getpass()
+    else:
+        user_name, password = None, None
+
+    job_index_cache = None
+    cache_ttl = global_config['jenkins'].get('cache-ttl', DEFAULT_CACHE_TTL)
+    if cache_ttl > 0:
+        job_index_cache = JobIndexCache(get_job_index_cache_file(), cache_ttl)
+
+    transport = create_transport(global_config)
+    jenkins = JenkinsClient(jenkins_url, user_name, password, job_index_cache, transport)
+    if _shared_clients is not None:
+        if shared_client is not None:
+            jenkins._job_index = shared_client._job_index
+        _shared_clients[jenkins_url] = jenkins
+    return jenkins
+
+
+#===================================================================================================
+# shared_jenkins_clients
+#===================================================================================================
+_shared_clients = None
+
+@contextlib.contextmanager
+def shared_jenkins_clients():
+    '''
+    Context manager that makes create_jenkins return the same client for all commands executed
+    inside it, so they share the authentication, connections and job index snapshot.
+    '''
+    global _shared_clients
+    previous_clients = _shared_clients
+    _shared_clients = {}
+    try:
+        yield
+    finally:
+        _shared_clients = previous_clients
+
+
+#===================================================================================================
+# create_transport
+#===================================================================================================
+_transports = {}
+
+def create_transport(global_config):
+    '''
+    Returns the HttpTransport used by commands, configured by the optional "connect-timeout",
+    "read-timeout", "retries" and "retry-budget" entries under "jenkins" in the global config.
+
+    The same transport (and so its pool of connections) is shared by all clients created with the
+    same configuration during a cit invocation; commands executed by cit.batch or the daemon get a
+    full budget of retries each.
+    '''
+    jenkins_config = global_config.get('jenkins', {})
+    kwargs = {}
+    for key in ('connect-timeout', 'read-timeout', 'retries', 'retry-budget'):
+        if key in jenkins_config:
+            kwargs[key.replace('-', '_')] = jenkins_config[key]
+
+    transport_key = tuple(sorted(kwargs.items()))
+    if transport_key not in _transports:
+        _transports[transport_key] = HttpTransport(**kwargs)
+    return _transports[transport_key]
+
+
+#===================================================================================================
+# print_http_stats
+#===================================================================================================
+def print_http_stats(stream=None):
+    '''
+    Reports the number of requests and connections made by the transports of this invocation.
+    '''
+    if stream is None:
+        stream = sys.stderr
+
+    for transport in _transports.itervalues():
+        print >> stream, 'http: %(requests)d request(s), %(opened)d connection(s) opened, ' \
+            '%(reused)d reused' % transport.get_stats()
+
+
+#===================================================================================================
+# Tracer
+#===================================================================================================
+class Tracer(object):
+    '''
+    Reports what a cit invocation spends its time with: every HTTP request and subprocess is logged
+    as it finishes, and a summary grouped by phase (loading configuration, querying git, obtaining
+    the job index...) is shown at the end.
+
+    Time is accounted to the innermost phase being executed by the thread: requests made by
+    worker threads outside of any phase of their own are accounted to the phase of the main
+    thread.
+    '''
+
+    ROOT_PHASE = 'command'
+
+    def __init__(self, stream=None):
+        '''
+        :param stream:
+            File-like object where the trace is written; defaults to the current sys.stderr.
+        '''
+        self._stream = stream
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._phases = []
+        self._stats = {}
+        self._start = time.time()
+        self._main_stack = self._get_stack()
+        self._main_stack.append([self.ROOT_PHASE, self._start, 0.0])
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        stack = self._get_stack()
+        stack.append([name, time.time(), 0.0])
+        try:
+            yield
+        finally:
+            name, start, children_time = stack.pop()
+            elapsed = time.time() - start
+            if stack:
+                stack[-1][2] += elapsed
+            self._add(name, time=elapsed - children_time)
+
+    def record_request(self, method, url, status, size, elapsed):
+        '''
+        :param int status: status of the response, None if the request failed.
+        :param int size: bytes in the body of the response.
+        :param float elapsed: seconds since the request was sent.
+        '''
+        if status is None:
+            status = 'ERROR'
+        self._write('%s %s %s %d bytes %.1f ms' % (method, url, status, size, elapsed * 1000.0))
+        self._add(self._get_phase(), requests=1, bytes=size, request_time=elapsed)
+
+    def record_process(self, args, exit_code, elapsed):
+        '''
+        :param int exit_code: None if the process couldn't be executed.
+        '''
+        if not isinstance(args, basestring):
+            args = ' '.join(args)
+        if exit_code is None:
+            exit_code = 'ERROR'
+        self._write('$ %s (exit code %s) %.1f ms' % (args, exit_code, elapsed * 1000.0))
+        self._add(self._get_phase(), processes=1, process_time=elapsed)
+
+    def finish(self):
+        '''
+        Ends the root phase and writes the summary.
+        '''
+        name, start, children_time = self._main_stack.pop()
+        elapsed = time.time() - start
+        self._add(name, time=elapsed - children_time)
+
+        self._write('%-12s %10s %9s %10s %10s %10s %10s' % (
+            'phase', 'time (ms)', 'requests', 'bytes', 'http (ms)', 'processes', 'proc (ms)'))
+        totals = dict.fromkeys(['requests', 'bytes', 'processes'], 0)
+        for name in self._phases:
+            stats = self._stats[name]
+            for key in totals:
+                totals[key] += stats[key]
+            self._write('%-12s %10.1f %9d %10d %10.1f %10d %10.1f' % (
+                name, stats['time'] * 1000.0, stats['requests'], stats['bytes'],
+                stats['request_time'] * 1000.0, stats['processes'], stats['process_time'] * 1000.0))
+        self._write('total: %.1f ms, %d request(s), %d bytes, %d process(es)' % (
+            elapsed * 1000.0, totals['requests'], totals['bytes'], totals['processes']))
+
+    def _get_stack(self):
+        try:
+            return self._local.stack
+        except AttributeError:
+            self._local.stack = []
+            return self._local.stack
+
+    def _get_phase(self):
+        stack = self._get_stack() or self._main_stack
+        if stack:
+            return stack[-1][0]
+        return self.ROOT_PHASE
+
+    def _add(self, phase, **values):
+        with self._lock:
+            if phase not in self._stats:
+                self._phases.append(phase)
+                self._stats[phase] = dict.fromkeys(
+                    ['time', 'requests', 'bytes', 'request_time', 'processes', 'process_time'], 0)
+            stats = self._stats[phase]
+            for key, value in values.iteritems():
+                stats[key] += value
+
+    def _write(self, line):
+        stream = self._stream
+        if stream is None:
+            stream = sys.stderr
+        with self._lock:
+            print >> stream, 'trace: ' + line
+
+
+#===================================================================================================
+# start_tracing
+#===================================================================================================
+_tracer = None
+_profiler = None
+_profile_file = None
+
+def start_tracing(trace=False, profile_file=None):
+    '''
+    Starts tracing (see Tracer) and/or profiling the current invocation; stop_tracing() reports
+    the results. Does nothing if already started.
+
+    :param str profile_file:
+        File where the cProfile statistics of the main thread are written.
+    '''
+    global _tracer, _profiler, _profile_file
+    if trace and _tracer is None:
+        _tracer = Tracer()
+    if profile_file and _profiler is None:
+        _profiler = cProfile.Profile()
+        _profile_file = profile_file
+        _profiler.enable()
+
+
+#===================================================================================================
+# stop_tracing
+#===================================================================================================
+def stop_tracing():
+    '''
+    Writes the trace summary and the profile started by start_tracing(), if any.
+    '''
+    global _tracer, _profiler
+    if _profiler is not None:
+        profiler, _profiler = _profiler, None
+        profiler.disable()
+        profiler.dump_stats(_profile_file)
+        print >> sys.stderr, 'profile written to %s (see "python -m pstats %s")' % (
+            _profile_file, _profile_file)
+    if _tracer is not None:
+        tracer, _tracer = _tracer, None
+        tracer.finish()
+
+
+#===================================================================================================
+# trace_phase
+#===================================================================================================
+class _NoPhase(object):
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+_NO_PHASE = _NoPhase()
+
+def trace_phase(name):
+    '''
+    Context manager that accounts what is executed inside it to the given phase when tracing.
+    '''
+    if _tracer is None:
+        return _NO_PHASE
+    return _tracer.phase(name)
+
+
 #===================================================================================================
-# clik initialization
-#
-# This block is used to initialize clik framework
-#
+# trace_request
 #===================================================================================================
+def trace_request(method, url, status, size, start):
+    '''
+    Reports a finished HTTP request when tracing.
+
+    :param float start: time when the request was sent.
+    '''
+    if _tracer is not None:
+        _tracer.record_request(method, url, status, size, time.time() - start)
+
 
 #===================================================================================================
-# get_global_config_file
+# trace_process
 #===================================================================================================
-def get_global_config_file():
+def trace_process(args, exit_code, start):
     '''
-    Returns the path to the global config file.
+    Reports a finished subprocess when tracing.
+
+    :param float start: time when the process was started.
     '''
-    # default values
-    global_config_file = os.environ.get('CIT_CONFIG')
-    if global_config_file is None:
-        global_config_file = os.path.join(os.path.dirname(__file__), 'citconfig.yaml')
-    return global_config_file
+    if _tracer is not None:
+        _tracer.record_process(args, exit_code, time.time() - start)
 
 
 #===================================================================================================
-# get_command_args
+# feature_branch_add
 #===================================================================================================
-def get_command_args(opts):
+jobs_option = opt('-j', '--jobs', type='int', default=1, metavar='N',
+    help='number of jobs processed in parallel (default: 1)')
+refresh_option = opt('--refresh', default=False, action='store_true',
+    help='ignore the cached job list and fetch it from the server')
+dry_run_option = opt('-n', '--dry-run', default=False, action='store_true',
+    help='only show what would be done')
+yes_option = opt('-y', '--yes', default=False, action='store_true',
+    help='don\'t ask for confirmation')
+format_option = opt('--format', type='choice', choices=['text', 'json', 'jsonl', 'csv'],
+    default='text', help='output format: text, json, jsonl or csv (default: %default)')
+@app(alias='fb.add', usage='[branch...] [options]', opts=[jobs_option, format_option])
+def feature_branch_add(args, branch, user_email, job_config, global_config, opts):
     '''
-    Returns a dict containing all extra options that commands in this module can receive as
-    arguments.
+    Create/Update jobs associated with the current git branch.
 
-    See clik framework for more details on this.
+    This will create one or more jobs on jenkins for the current feature branch,
+    or for the ones given as parameters if any are provided. The configuration of the
+    source jobs is obtained only once for all branches.
+
+    With "--jobs N" up to N jobs are created/updated at the same time; results are still reported
+    in the order the jobs are configured. A failure in one job does not stop the others.
+
+    With "--format" a record is written for each job, with its "branch", "source" job, "name",
+    "status" and "error"; other messages (warnings) are written to stderr.
     '''
-    cit_file_name, job_config = load_cit_local_config(os.getcwd())
+    branches = args or [branch]
 
-    # user, email, branch
-    user_name, user_email = get_git_user()
-    branch = get_git_branch()
+    jenkins = create_jenkins(global_config, authenticate=True)
+    source_configs = SourceJobConfigs(jenkins)
+    record_writer = create_record_writer(opts, ['branch', 'source', 'name', 'status', 'error'])
+
+    # output of each job is buffered so parallel jobs don't mix their messages
+    outputs = {}
+    def create(branch_job):
+        branch_name, job_name, new_job_name = branch_job
+        stream = outputs[new_job_name] = StringIO.StringIO()
+        return create_feature_branch_job(
+            jenkins, job_name, new_job_name, branch_name, user_email, stream, source_configs)
+
+    configured_jobs = [
+        (branch_name, job_name, new_job_name)
+        for branch_name in branches
+        for job_name, new_job_name in get_configured_jobs(branch_name, job_config)
+    ]
+    failures = 0
+    for branch_job, status, error in imap_in_threads(create, configured_jobs, opts.jobs):
+        branch_name, job_name, new_job_name = branch_job
+        if record_writer is not None:
+            # messages after the status line of the job are warnings
+            output = outputs[new_job_name].getvalue().split('\n', 1)[-1]
+            sys.stderr.write(output)
+            if error is not None:
+                failures += 1
+                status = 'ERROR'
+            record_writer.write({
+                'branch' : branch_name,
+                'source' : job_name,
+                'name' : new_job_name,
+                'status' : status,
+                'error' : error and str(error),
+            })
+            continue
 
-    global_config_file = get_global_config_file()
+        sys.stdout.write(outputs[new_job_name].getvalue())
+        if error is not None:
+            failures += 1
+            print '%s => %s (ERROR: %s)' % (job_name, new_job_name, error)
 
-    # read global config
-    if os.path.isfile(global_config_file):
-        global_config = yaml.load(file(global_config_file).read())
-    else:
-        global_config = {}
+    if record_writer is not None:
+        record_writer.finish()
+    if failures:
+        print >> sys.stderr, 'error: %d of %d job(s) failed' % (failures, len(configured_jobs))
+        return 1
 
-    return {
-        'job_config' : job_config,
-        'global_config' : global_config,
-        'user_name' : user_name,
-        'user_email' : user_email,
-        'branch' : branch,
-    }
 
+#===================================================================================================
+# feature_branch_rm
+#===================================================================================================
+@app(alias='fb.rm', usage='[branch] [options]',
+    opts=[jobs_option, dry_run_option, format_option])
+def feature_branch_rm(args, branch, global_config, job_config, opts):
+    '''
+    Remove jobs associated with the current git branch.
+
+    This will remove one or more jobs from jenkins created previously with "feature_branch_add".
+    If no branch is given the current one will be used.
+    '''
+    if args:
+        branch = args[0]
+
+    jenkins = create_jenkins(global_config, authenticate=not opts.dry_run)
+    if opts.dry_run:
+        # the jobs that would be deleted are found in the job index
+        jenkins.get_job_index(refresh=True)
+    record_writer = create_record_writer(opts, REMOVE_RECORD_FIELDS)
 
+    # jobs that don't exist are found out when deleting them
+    job_names = [new_job_name for _, new_job_name in get_configured_jobs(branch, job_config)]
+    failures = remove_jobs(jenkins, job_names, opts.jobs, opts.dry_run, record_writer)
+    if record_writer is not None:
+        record_writer.finish()
+    if failures:
+        return 1
 
-app = clik.App(
-    name='cit',
-    description='Command line tool for interacting with a Jenkins integration server.\n',
-    args_callback=get_command_args,
-    shell_command=False,
-    console_opts=False,
+
+#===================================================================================================
+# feature_branch_start
+#===================================================================================================
+wait_option = opt(
+    '--wait',
+    help='wait until the builds finish, failing if any of them fails',
+    default=False,
+    action='store_true',
 )
+START_RECORD_FIELDS = ['name', 'status', 'number', 'result']
+
+@app(alias='fb.start', usage='[branch] [options]', opts=[wait_option, format_option])
+def feature_branch_start(args, branch, job_config, global_config, opts):
+    '''
+    Start jobs associated with the current git branch.
+
+    With "--wait" the status of each build is shown as it finishes, and the command fails if any
+    of the builds doesn't succeed.
+
+    With "--format" a record is written for each job, with its "name" and "status" and, with
+    "--wait", the "number" and "result" of the build (written when the build finishes).
+    '''
+    if args:
+        branch = args[0]
+
+    jenkins = create_jenkins(global_config, authenticate=True)
+    record_writer = create_record_writer(opts, START_RECORD_FIELDS)
+
+    builds = []
+    not_found = 0
+    for _, new_job_name in get_configured_jobs(branch, job_config):
+        try:
+            job = jenkins.get_job(new_job_name)
+        except UnknownJob:
+            status = 'NOT FOUND'
+            not_found += 1
+        else:
+            if not opts.wait:
+                if not job.is_running():
+                    job.invoke()
+                    status = 'STARTED'
+                else:
+                    status = 'RUNNING'
+            else:
+                build = {'job_name' : new_job_name, 'queue_url' : None, 'number' : None}
+                try:
+                    last_build = job.get_last_build()
+                except NoBuildData:
+                    last_build = None
+                if last_build is not None and last_build.is_running():
+                    build['number'] = last_build.get_number()
+                    status = 'RUNNING'
+                else:
+                    build['queue_url'] = job.invoke()
+                    status = 'STARTED'
+                build['status'] = status
+                builds.append(build)
+
+        if record_writer is None:
+            print new_job_name, '(%s)' % status
+        elif not opts.wait or status == 'NOT FOUND':
+            # with "--wait" the record is written when the build finishes
+            record_writer.write({'name' : new_job_name, 'status' : status})
+
+    results = {}
+    if opts.wait:
+        sys.stdout.flush()
+        results = wait_for_builds(jenkins, builds, record_writer=record_writer)
+    if record_writer is not None:
+        record_writer.finish()
+
+    failed = not_found + len([r for r in results.itervalues() if r != 'SUCCESS'])
+    if opts.wait and failed:
+        total = not_found + len(builds)
+        print >> sys.stderr, 'error: %d of %d job(s) failed' % (failed, total)
+        return 1
+
 
 #===================================================================================================
-# Feature Branch Commands
-# -----------------------
-#
-# The next commands deal with feature branch jobs for the git repository in the current directory.
-#
+# wait_for_builds
 #===================================================================================================
+WAIT_INTERVAL = 2
+WAIT_MAX_INTERVAL = 30
+WAIT_WORKERS = 8
+WAIT_MAX_UNREACHABLE = 5
+
+def wait_for_builds(jenkins, builds, stream=None, record_writer=None):
+    '''
+    Waits until the given builds finish, writing the result of each one as soon as it finishes.
+
+    All builds are followed by the same loop: on each round the state of every build not finished
+    yet is queried (concurrently), and the time between rounds doubles up to WAIT_MAX_INTERVAL, as
+    most builds take a while to finish.
+
+    :param list(dict) builds:
+        Each build has the "job_name" and either the "number" of the build or, for builds still
+        in the queue, the "queue_url" of the queue item (see JenkinsJob.invoke), which is followed
+        until the build starts.
+
+    :param stream:
+        File-like object where results are written; defaults to sys.stdout.
+
+    :param RecordWriter record_writer:
+        If given, the result of each build is written as a record (see START_RECORD_FIELDS)
+        instead, with the "status" given for the build (if any).
+
+    :return dict:
+        Maps the name of each job to the result of its build ("SUCCESS", "FAILURE", etc);
+        "CANCELLED" if the build was removed from the queue, "NOT FOUND" if the job or build
+        disappeared, "UNKNOWN" if the build can't be followed and "ERROR: <message>" if the server
+        answered with an error, or could not be reached in WAIT_MAX_UNREACHABLE consecutive rounds.
+    '''
+    import urllib2
+
+    if stream is None:
+        stream = sys.stdout
+
+    def poll(build):
+        '''
+        :return str: the result of the build, or None if it has not finished yet.
+        '''
+        try:
+            if build['number'] is None:
+                if build['queue_url'] is None:
+                    return 'UNKNOWN'
+                queue_item = jenkins.get_json(build['queue_url'], 'cancelled,executable[number]')
+                if queue_item.get('cancelled'):
+                    return 'CANCELLED'
+                if not queue_item.get('executable'):
+                    return None
+                build['number'] = queue_item['executable']['number']
+
+            # not using get_job: it relies on the (cached) job index, a 404 tells the job is gone
+            job_build = JenkinsJob(jenkins, build['job_name']).get_build(build['number'])
+            if job_build.is_running():
+                return None
+            # aborted builds may have no result
+            return job_build.get_status() or 'ABORTED'
+        except urllib2.HTTPError, e:
+            if e.code == 404:
+                return 'NOT FOUND'
+            raise
+
+    results = {}
+    pending = list(builds)
+    interval = WAIT_INTERVAL
+    while pending:
+        time.sleep(interval)
+        interval = min(interval * 2, WAIT_MAX_INTERVAL)
+
+        still_pending = []
+        for build, result, error in imap_in_threads(poll, pending, WAIT_WORKERS):
+            if error is not None:
+                # the server could not be reached even after the transport retries: assume it is
+                # temporary, as builds usually take longer than that, but not for too many rounds
+                if isinstance(error, urllib2.URLError) and not isinstance(error, urllib2.HTTPError):
+                    build['unreachable'] = build.get('unreachable', 0) + 1
+                    if build['unreachable'] < WAIT_MAX_UNREACHABLE:
+                        still_pending.append(build)
+                        continue
+                result = 'ERROR: %s' % error
+            elif result is None:
+                build['unreachable'] = 0
+                still_pending.append(build)
+                continue
+            results[build['job_name']] = result
+            if record_writer is not None:
+                record_writer.write({
+                    'name' : build['job_name'],
+                    'status' : build.get('status'),
+                    'number' : build['number'],
+                    'result' : result,
+                })
+            elif build['number'] is None:
+                print >> stream, build['job_name'], '(%s)' % result
+            else:
+                print >> stream, '%s #%d (%s)' % (build['job_name'], build['number'], result)
+            stream.flush()
+        pending = still_pending
+
+    return results
+
 
 #===================================================================================================
-# create_feature_branch_job
+# feature_branch_gc
 #===================================================================================================
-def create_feature_branch_job(jenkins, job_name, new_job_name, branch, user_email):
-    try:
-        job = jenkins.get_job(new_job_name)
-    except UnknownJob:
-        status = 'CREATED'
-        job = jenkins.copy_job(job_name, new_job_name)
-    else:
-        status = 'UPDATED'
+DEFAULT_GC_DAYS = 7
+
+gc_opts = [
+    opt('--remote', default='origin', help='remote whose branches are checked (default: %default)'),
+    opt('--days', type='int', default=DEFAULT_GC_DAYS, metavar='N',
+        help='keep jobs built in the last N days, even if their branch is gone (default: %default)'),
+    opt('--never-built', default=False, action='store_true',
+        help='also delete jobs that were never built (kept by default)'),
+    jobs_option,
+    dry_run_option,
+    yes_option,
+    format_option,
+]
+@app(alias='fb.gc', usage='[options]', opts=gc_opts)
+def feature_branch_gc(job_config, global_config, opts):
+    '''
+    Deletes feature branch jobs whose branches don't exist anymore.
 
-    # this workaround is required otherwise when copying
-    # jobs using the remote-API they are created as
-    # non-buildable for some reason
-    job.disable()
+    Jobs matching the feature branch jobs configured in .cit.yaml are deleted when their branch is
+    not found in the remote repository, unless they are running or were built recently. Jobs that
+    were never built are only deleted with "--never-built". Only jobs whose configuration builds
+    that branch (as created by fb.add) are considered.
 
-    print '%s => %s (%s)' % (job_name, new_job_name, status)
+    "--format" can only be used without confirmation ("--yes" or "--dry-run").
+    '''
+    if opts.format != 'text' and not opts.dry_run and not opts.yes:
+        print >> sys.stderr, 'error: --format requires --yes or --dry-run'
+        return 2
 
-    original_job = jenkins.get_job(job_name)
-    tree = ET.fromstring(original_job.get_config())
+    branches = get_remote_branches(opts.remote)
+    if not branches:
+        # never consider every job an orphan because the remote could not be queried
+        print >> sys.stderr, 'error: could not obtain the branches of remote %r' % opts.remote
+        return 1
+
+    jenkins = create_jenkins(global_config, authenticate=not opts.dry_run)
+    # running and recently built jobs are kept based on it, so it must be current
+    job_index = jenkins.get_job_index(refresh=True)
+    candidates = find_orphan_jobs(
+        job_index, job_config, branches, opts.days, never_built=opts.never_built)
+
+    # a job whose name just looks like a feature branch job (like "project_$name" matching
+    # "project_release") is only deleted if it really builds one of the branches its name implies
+    orphans = []
+    get_branch = lambda candidate: get_job_branch(jenkins, candidate[0])
+    for (job_name, job_branches, reason), branch, error in imap_in_threads(
+        get_branch, candidates, opts.jobs):
+        if error is not None:
+            print >> sys.stderr, 'warning: could not check job %s: %s' % (job_name, error)
+        elif branch in job_branches:
+            orphans.append((job_name, reason))
+
+    if not opts.dry_run and not opts.yes:
+        for job_name, reason in orphans:
+            print '\t%s (%s)' % (job_name, reason)
+        print 'Found: %d jobs' % len(orphans)
+        if not orphans:
+            return
+        ans = raw_input("Delete jobs?(y|*n): ")
+        if not ans.startswith('y'):
+            return
 
-    branch_elements = list(tree.findall('.//hudson.plugins.git.BranchSpec/name'))
-    if len(branch_elements) > 0:
-        branch_elements[0].text = branch
-    else:
-        print '  warning: Could not find any branch spec to replace!'
+    record_writer = create_record_writer(opts, REMOVE_RECORD_FIELDS)
+    failures = remove_jobs(
+        jenkins, [job_name for job_name, _ in orphans], opts.jobs, opts.dry_run, record_writer)
+    if record_writer is not None:
+        record_writer.finish()
+    if failures:
+        return 1
 
-    # If displayName exists adds the feature branch name to it.
-    display_name_elem = tree.find('./displayName')
-    if display_name_elem is not None:
-        display_name_elem.text = '%(branch_name)s %(display_name)s' % {'display_name':display_name_elem.text, 'branch_name':branch}
 
-    recipient_elements = list(tree.findall('.//hudson.tasks.Mailer/recipients'))
-    if len(recipient_elements) == 1:
-        recipient_element = recipient_elements[0]
-        recipient_element.text = user_email
+#===================================================================================================
+# find_orphan_jobs
+#===================================================================================================
+def find_orphan_jobs(job_index, job_config, branches, days, now=None, never_built=False):
+    '''
+    Finds feature branch jobs whose branch doesn't exist anymore.
 
-    # remove properties from the build so we can use "start" to start-up jobs
-    properties_elem = tree.find('./properties')
-    if properties_elem is not None:
-        for elem in properties_elem.findall('./hudson.model.ParametersDefinitionProperty'):
-            properties_elem.remove(elem)
+    A job name may match many of the configured feature branch jobs (like "project_$name" and
+    "project_$name_win32"); it is an orphan only if none of the branches it may belong to exist.
+    Parts of job names that can't be branch names (see is_valid_branch_name) are ignored. Source
+    jobs, running jobs and jobs built in the last `days` days are never orphans; jobs that were
+    never built are orphans only if `never_built` is true, since there is no build age to tell
+    whether they were just created.
 
-    # remove build triggers after this job
-    publishers_elem = tree.find('./publishers')
-    if publishers_elem is not None:
-        for elem in publishers_elem.findall('./hudson.tasks.BuildTrigger'):
-            publishers_elem.remove(elem)
+    Only job names are checked: jobs that were not created from a source job may also be found,
+    so the branch each job actually builds should be checked (see get_job_branch).
 
-    job.update_config(ET.tostring(tree))
+    :param list(dict) job_index:
+        See JenkinsClient.get_job_index.
 
-    # part #2 of the workaround
-    job.enable()
+    :param set(str) branches:
+        Names of existing branches.
 
-    return job
+    :param float now:
+        Current time (seconds since the epoch); by default obtained from the system.
 
+    :param bool never_built:
+        If true, jobs that were never built (and are not running) may also be orphans.
 
-def create_jenkins(global_config, authenticate=False):
-    jenkins_url = global_config['jenkins']['url']
-    if authenticate:
-        try:
-            user_name = global_config['jenkins']['user']
-            password = global_config['jenkins']['pass']
-            assert user_name and password
-        except:
-            print "Note: 'user' and 'pass' can be specified in citconfig.yaml (under jenkins)"
-            user_name = raw_input('Username:')
-            password = getpass.getpass()
-    else:
-        user_name, password = None, None
+    :return list(tuple(str, list(str), str)):
+        The name of each orphan job, the branches it may belong to and the reason why it is an
+        orphan, in the index order.
+    '''
+    if now is None:
+        now = time.time()
+
+    source_jobs = set(entry['source-job'] for entry in job_config.get('jobs', []))
+    job_regexes = []
+    for entry in job_config.get('jobs', []):
+        parts = [re.escape(part) for part in entry['feature-branch-job'].split('$name')]
+        if len(parts) > 1:
+            # the branch name is the same wherever "$name" appears
+            regex = parts[0] + '(?P<name>.+)' + '(?P=name)'.join(parts[1:])
+            job_regexes.append(re.compile(regex + '$'))
+
+    orphans = []
+    for job_entry in job_index:
+        job_name = job_entry['name']
+        if job_name in source_jobs:
+            continue
+        job_branches = []
+        for job_regex in job_regexes:
+            match = job_regex.match(job_name)
+            if match is not None and is_valid_branch_name(match.group('name')):
+                job_branches.append(match.group('name'))
+        if not job_branches or branches.intersection(job_branches):
+            continue
+        # reported as the branch of the most specific feature branch job
+        branch = min(job_branches, key=len)
+
+        last_build = job_entry.get('lastBuild')
+        if last_build is None:
+            if not never_built or (job_entry.get('color') or '').endswith('_anime'):
+                continue
+            reason = 'branch %s not found, never built' % branch
+        else:
+            if last_build['building']:
+                continue
+            age = (now - last_build['timestamp'] / 1000.0) / (24 * 60 * 60)
+            if age < days:
+                continue
+            reason = 'branch %s not found, last built %d days ago' % (branch, age)
+        orphans.append((job_name, job_branches, reason))
 
-    j = Jenkins(jenkins_url, user_name, password)
-    return j
+    return orphans
 
 
 #===================================================================================================
-# feature_branch_add
+# is_valid_branch_name
 #===================================================================================================
-@app(alias='fb.add', usage='[branch]')
-def feature_branch_add(args, branch, user_email, job_config, global_config):
+def is_valid_branch_name(name):
     '''
-    Create/Update jobs associated with the current git branch.
+    :return bool: whether the given name can be the name of a git branch (see git check-ref-format).
+    '''
+    if not name or name == '@' or name.startswith('-') or name.startswith('/'):
+        return False
+    if name.endswith('/') or name.endswith('.'):
+        return False
+    for invalid in ('..', '//', '@{', ' ', '~', '^', ':', '?', '*', '[', '\\'):
+        if invalid in name:
+            return False
+    if [c for c in name if ord(c) < 32 or ord(c) == 127]:
+        return False
+    return not [
+        part for part in name.split('/') if part.startswith('.') or part.endswith('.lock')]
 
-    This will create one or more jobs on jenkins for the current feature branch,
-    or for the one given as parameter if one is provided.
+
+#===================================================================================================
+# get_job_branch
+#===================================================================================================
+def get_job_branch(jenkins, job_name):
     '''
-    if args:
-        branch = args[0]
+    :return str:
+        The branch built by a job: the first git branch spec in its configuration, which is the
+        one set for feature branch jobs (see create_feature_branch_job); None if there's none.
+    '''
+    import xml.etree.ElementTree as ET
 
-    jenkins = create_jenkins(global_config, authenticate=True)
-    for job_name, new_job_name in get_configured_jobs(branch, job_config):
-        create_feature_branch_job(jenkins, job_name, new_job_name, branch, user_email)
+    config_xml = JenkinsJob(jenkins, job_name).get_config()
+    with trace_phase('xml'):
+        branch_element = ET.fromstring(config_xml).find('.//hudson.plugins.git.BranchSpec/name')
+    if branch_element is None:
+        return None
+    return branch_element.text
 
 
 #===================================================================================================
-# feature_branch_rm
+# feature_branch_log
 #===================================================================================================
-@app(alias='fb.rm', usage='[branch]')
-def feature_branch_rm(args, branch, global_config, job_config):
+follow_option = opt(
+    '-f', '--follow',
+    help='keep showing the output until the builds finish',
+    default=False,
+    action='store_true',
+)
+@app(alias='fb.log', usage='[branch] [options]', opts=[follow_option])
+def feature_branch_log(args, branch, job_config, global_config, opts):
     '''
-    Remove jobs associated with the current git branch.
+    Shows the console output of the last build of the jobs associated with the current git branch.
 
-    This will remove one or more jobs from jenkins created previously with "feature_branch_add".
-    If no branch is given the current one will be used.
+    When there are many jobs, each line is prefixed with the name of its job. With "--follow" the
+    output keeps being shown as the builds produce it, until all of them finish.
     '''
     if args:
         branch = args[0]
 
-    jenkins = create_jenkins(global_config, authenticate=True)
-    for _, new_job_name in get_configured_jobs(branch, job_config):
-        if jenkins.has_job(new_job_name):
-            jenkins.delete_job(new_job_name)
-            print new_job_name, '(REMOVED)'
+    jenkins = create_jenkins(global_config)
+
+    job_names = [new_job_name for _, new_job_name in get_configured_jobs(branch, job_config)]
+    width = max([len(job_name) for job_name in job_names] or [0])
+    logs = []
+    for job_name in job_names:
+        try:
+            job = jenkins.get_job(job_name)
+        except UnknownJob:
+            print >> sys.stderr, job_name, '(NOT FOUND)'
+            continue
+        try:
+            number = job.get_last_build().get_number()
+        except NoBuildData:
+            print >> sys.stderr, job_name, '(NO BUILDS)'
+            continue
+        if len(job_names) > 1:
+            prefix = '%-*s | ' % (width, job_name)
         else:
-            print new_job_name, '(NOT FOUND)'
+            prefix = ''
+        logs.append({
+            'job' : job,
+            'number' : number,
+            'start' : 0,
+            'writer' : LinePrefixWriter(sys.stdout, prefix),
+        })
+
+    follow_logs(logs, opts.follow)
 
 
 #===================================================================================================
-# feature_branch_start
+# follow_logs
 #===================================================================================================
-@app(alias='fb.start', usage='[branch]')
-def feature_branch_start(args, branch, job_config, global_config):
-    '''
-    Start jobs associated with the current git branch.
+FOLLOW_INTERVAL = 1
+FOLLOW_MAX_INTERVAL = 10
+
+def follow_logs(logs, follow):
     '''
-    if args:
-        branch = args[0]
+    Writes the console output of builds, obtaining only the output not written yet on each
+    request (see JenkinsJob.read_log).
 
-    jenkins = create_jenkins(global_config, authenticate=True)
+    :param list(dict) logs:
+        Each one with the "job", build "number", "start" offset of the output and the
+        LinePrefixWriter where the output is written.
 
-    for _, new_job_name in get_configured_jobs(branch, job_config):
-        if jenkins.has_job(new_job_name):
-            job = jenkins.get_job(new_job_name)
-            if not job.is_running():
-                job.invoke()
-                status = '(STARTED)'
+    :param bool follow:
+        If True, keeps polling the builds that are running until they finish; the interval between
+        polls doubles (up to FOLLOW_MAX_INTERVAL) while no build produces output.
+    '''
+    pending = list(logs)
+    interval = FOLLOW_INTERVAL
+    while pending:
+        received = False
+        still_pending = []
+        for log in pending:
+            start, more_data = log['job'].read_log(log['number'], log['start'], log['writer'])
+            received = received or start != log['start']
+            log['start'] = start
+            if follow and more_data:
+                still_pending.append(log)
             else:
-                status = '(RUNNING)'
-        else:
-            status = '(NOT FOUND)'
-        print new_job_name, status
+                log['writer'].finish()
+        sys.stdout.flush()
+
+        pending = still_pending
+        if pending:
+            if received:
+                interval = FOLLOW_INTERVAL
+            else:
+                interval = min(interval * 2, FOLLOW_MAX_INTERVAL)
+            time.sleep(interval)
 
 
 #===================================================================================================
@@ -265,6 +2131,8 @@ def feature_branch_init():
     as basis for feature branch jobs at your Jenkins server. Usually you will want all
     job variations that build the "master" branch.
     '''
+    import yaml
+
     cit_file_name, config = load_cit_local_config(os.getcwd())
 
     print 'Configuring jobs for feature branches: %s' % cit_file_name
@@ -315,18 +2183,35 @@ def feature_branch_init():
 re_option = opt('--re', help='pattern is a regular expression', default=False, action='store_true')
 list_jobs_opts = [
     re_option,
+    refresh_option,
     opt('-i', '--interactive', help='interactively remove or start them', default=False, action='store_true'),
+    format_option,
 ]
 @app(alias='sv.ls', usage='<pattern> [options]', opts=list_jobs_opts)
-def server_list_jobs(args, global_config, opts, authenticate=False):
+def server_list_jobs(args, global_config, opts):
+    '''
+    Lists the jobs whose name match a given pattern.
+
+    With "--format" a record is written for each job instead, with the JOB_RECORD_FIELDS.
+    '''
+    if opts.interactive and opts.format != 'text':
+        print >> sys.stderr, 'error: --format can\'t be used with --interactive'
+        return 2
+    result = list_jobs(args, global_config, opts)
+    if isinstance(result, int):
+        return result
+
+
+#===================================================================================================
+# list_jobs
+#===================================================================================================
+def list_jobs(args, global_config, opts, authenticate=False):
     '''
     Lists the jobs whose name match a given pattern.
 
     :param bool authenticate:
         Flag used to notify Jenkins that authentication information must be requested to user.
     '''
-    import fnmatch
-
     if len(args) < 1:
         print >> sys.stderr, 'error: missing pattern'
         return 2
@@ -340,21 +2225,20 @@ def server_list_jobs(args, global_config, opts, authenticate=False):
 
     jenkins = create_jenkins(global_config, authenticate)
 
-    def match(job_name):
-        if opts.re:
-            return re.match(pattern, job_name)
-        else:
-            return fnmatch.fnmatch(jobname, pattern)
-
     jobs = []
-    for jobname in jenkins.iterkeys():
-        if match(jobname):
-            job = jenkins.get_job(jobname)
-            if opts.interactive:
-                print get_job_status(jobname, job, len(jobs))
-            else:
-                print '\t', jobname
-            jobs.append((jobname, job))
+    record_writer = create_record_writer(opts, JOB_RECORD_FIELDS)
+    job_index = jenkins.get_job_index(getattr(opts, 'refresh', False))
+    for job_entry in match_jobs(job_index, pattern, opts.re):
+        jobname = job_entry['name']
+        if record_writer is not None:
+            record_writer.write(get_job_record(jenkins, job_entry))
+        elif opts.interactive:
+            print get_job_status(job_entry, len(jobs))
+        else:
+            print '\t', jobname
+        jobs.append((jobname, JenkinsJob(jenkins, jobname)))
+    if record_writer is not None:
+        record_writer.finish()
 
     def delete_jobs(jobs):
         while True:
@@ -432,56 +2316,75 @@ def server_list_jobs(args, global_config, opts, authenticate=False):
 #===================================================================================================
 # server_jobs_status
 #===================================================================================================
-re_option = opt('--re', help='pattern is a regular expression', default=False, action='store_true')
 list_jobs_opts = [
     re_option,
+    refresh_option,
 #     opt('-i', '--interactive', help='interactively remove or start them', default=False, action='store_true'),
+    opt('-w', '--watch', help='keep showing the status of the jobs as it changes', default=False, action='store_true'),
+    opt('--interval', help='seconds between updates with --watch (default: %default)', type='float', default=5, metavar='SECONDS'),
+    format_option,
 ]
 @app(alias='sv.st', usage='<pattern> [options]', opts=list_jobs_opts)
 def server_jobs_status(args, global_config, opts):
     '''
     Lists the jobs whose name match a given pattern.
-    '''
-    import fnmatch
 
-    track_jobs_file = os.path.join(os.path.dirname(__file__), 'cittrackjobs.yaml')
-    if os.path.isfile(track_jobs_file):
-        track_jobs_config = yaml.load(file(track_jobs_file).read())
-    else:
-        track_jobs_config = {
-            'pattern' : 'etk-*fb-*',
-        }
+    With "--watch" the status of the jobs keeps being updated until interrupted with Ctrl+C.
+
+    After listing the jobs an operation on them is asked for, unless the input is not a terminal.
+
+    With "--format" a record is written for each job instead (with the JOB_RECORD_FIELDS), and no
+    operation is asked for; with "--watch" a new record is written whenever the status of a job
+    changes.
+    '''
+    track_jobs_config = load_track_jobs_config()
 
     update_list = False
     if len(args) == 1:
         pattern = track_jobs_config['pattern'] = args[0]
         update_list = True
-        f = file(track_jobs_file, 'w')
-        f.write(yaml.dump(track_jobs_config, default_flow_style=False))
-        f.close()
+        save_track_jobs_config(track_jobs_config)
     else:
         pattern = track_jobs_config['pattern']
 
+    def get_job_entries(job_index):
+        if not update_list and len(track_jobs_config.get('jobs', [])) > 0:
+            job_entries = dict((job_entry['name'], job_entry) for job_entry in job_index)
+            return [
+                job_entries.get(jobname, {'name' : jobname, 'color' : None})
+                for jobname in track_jobs_config['jobs']
+            ]
+        else:
+            return match_jobs(job_index, pattern, opts.re)
+
     jenkins = create_jenkins(global_config)
+    record_writer = create_record_writer(opts, JOB_RECORD_FIELDS)
+    if opts.watch:
+        try:
+            watch_jobs_status(jenkins, get_job_entries, opts.interval, record_writer=record_writer)
+        except KeyboardInterrupt:
+            pass
+        if record_writer is not None:
+            record_writer.finish()
+        return
 
-    def match(job_name):
-        if opts.re:
-            return re.match(pattern, job_name)
-        else:
-            return fnmatch.fnmatch(jobname, pattern)
+    job_index = jenkins.get_job_index(opts.refresh)
+    if not opts.refresh and not update_list:
+        # tracked jobs created after the cached index was obtained would be shown as missing
+        job_names = set(job_entry['name'] for job_entry in job_index)
+        if [name for name in track_jobs_config.get('jobs', []) if name not in job_names]:
+            job_index = jenkins.get_job_index(refresh=True)
+
+    if record_writer is not None:
+        for job_entry in get_job_entries(job_index):
+            record_writer.write(get_job_record(jenkins, job_entry))
+        record_writer.finish()
+        return
 
     jobs = []
-    if not update_list and len(track_jobs_config.get('jobs', [])) > 0:
-        for jobname in track_jobs_config['jobs']:
-            job = jenkins.get_job(jobname)
-            print get_job_status(jobname, job, len(jobs))
-            jobs.append((jobname, job))
-    else:
-        for jobname in jenkins.iterkeys():
-            if match(jobname):
-                job = jenkins.get_job(jobname)
-                print get_job_status(jobname, job, len(jobs))
-                jobs.append((jobname, job))
+    for job_entry in get_job_entries(job_index):
+        print get_job_status(job_entry, len(jobs))
+        jobs.append((job_entry['name'], JenkinsJob(jenkins, job_entry['name'])))
 
     def delete_jobs(jobs):
         while True:
@@ -525,6 +2428,10 @@ def server_jobs_status(args, global_config, opts):
 
         return None, None
 
+    # the operations can only be asked for when someone is there to answer, not in scripts
+    if not sys.stdin.isatty():
+        return
+
     # TODO: remove this option from here, it belongs in a separate command
     ans = raw_input('Select an operation? (add | op(en url) | *e(xit)): ').lower()
     if not ans or ans.startswith('e'):
@@ -537,10 +2444,7 @@ def server_jobs_status(args, global_config, opts):
                 track_jobs_config['jobs'].append(job_name)
             except KeyError:
                 track_jobs_config['jobs'] = [job_name]
-
-            f = file(track_jobs_file, 'w')
-            f.write(yaml.dump(track_jobs_config, default_flow_style=False))
-            f.close()
+            save_track_jobs_config(track_jobs_config)
 
     elif ans == 'op':
         job_name, job = get_job()
@@ -549,6 +2453,95 @@ def server_jobs_status(args, global_config, opts):
             os.startfile(url)
 
 
+#===================================================================================================
+# get_track_jobs_file
+#===================================================================================================
+def get_track_jobs_file():
+    '''
+    Returns the path to the file with the jobs tracked by "sv.st", which lives alongside cit.
+    '''
+    return os.path.join(os.path.dirname(__file__), 'cittrackjobs.yaml')
+
+
+#===================================================================================================
+# load_track_jobs_config
+#===================================================================================================
+def load_track_jobs_config():
+    '''
+    :return dict:
+        The "pattern" of the jobs tracked by "sv.st" and, optionally, the names of tracked "jobs"
+        (shown instead of those matching the pattern).
+    '''
+    track_jobs_file = get_track_jobs_file()
+    if os.path.isfile(track_jobs_file):
+        return load_config_file(track_jobs_file, TRACK_JOBS_SCHEMA)
+    return {
+        'pattern' : 'etk-*fb-*',
+    }
+
+
+#===================================================================================================
+# save_track_jobs_config
+#===================================================================================================
+def save_track_jobs_config(track_jobs_config):
+    import yaml
+
+    f = file(get_track_jobs_file(), 'w')
+    try:
+        # job names obtained from the server are unicode, which yaml.dump would tag as python objects
+        f.write(yaml.safe_dump(track_jobs_config, default_flow_style=False))
+    finally:
+        f.close()
+
+
+#===================================================================================================
+# server_track_jobs
+#===================================================================================================
+@app(alias='sv.track', usage='<pattern> [options]', opts=[
+    re_option,
+    refresh_option,
+    opt('--remove', default=False, action='store_true',
+        help='stop tracking the tracked jobs matching the pattern'),
+])
+def server_track_jobs(args, opts, global_config):
+    '''
+    Adds the jobs whose name match a given pattern to the jobs tracked by "sv.st" (shown when it is
+    called without a pattern).
+
+    With "--remove" the tracked jobs matching the pattern stop being tracked instead.
+    '''
+    if len(args) != 1:
+        print >> sys.stderr, 'error: expected a pattern'
+        return 2
+
+    track_jobs_config = load_track_jobs_config()
+    tracked_jobs = track_jobs_config.get('jobs', [])
+
+    if opts.remove:
+        job_names = [job_entry['name'] for job_entry in match_jobs(
+            [{'name' : job_name} for job_name in tracked_jobs], args[0], opts.re)]
+        for job_name in job_names:
+            print job_name, '(UNTRACKED)'
+        tracked_jobs = [job_name for job_name in tracked_jobs if job_name not in job_names]
+    else:
+        jenkins = create_jenkins(global_config)
+        job_index = jenkins.get_job_index(opts.refresh)
+        job_names = [job_entry['name'] for job_entry in match_jobs(job_index, args[0], opts.re)]
+        for job_name in job_names:
+            if job_name in tracked_jobs:
+                print job_name, '(ALREADY TRACKED)'
+            else:
+                print job_name, '(TRACKED)'
+                tracked_jobs.append(job_name)
+
+    print 'Tracked: %d jobs' % len(tracked_jobs)
+    if tracked_jobs:
+        track_jobs_config['jobs'] = tracked_jobs
+    else:
+        track_jobs_config.pop('jobs', None)
+    save_track_jobs_config(track_jobs_config)
+
+
 @app(alias='sv.ld', usage='<pattern> [project]')
 def server_jobs_deps(args, global_config, opts):
     project_name = args[0]
@@ -621,41 +2614,11 @@ def server_jobs_link(args, global_config, opts):
     
     jenkins = create_jenkins(global_config, authenticate=True)
 
-    checked_names = set()
+    # jobs are changed based on it, so a cached job index is not good enough
+    job_names = set(job_entry['name'] for job_entry in jenkins.get_job_index(refresh=True))
 
     def HasJob(job_name):
-        if job_name in checked_names:
-            return True
-
-        ret = jenkins.has_job(job_name)
-        if ret:
-            checked_names.add(ret)
-
-        return ret
-
-
-    def GetXmlConfig(job):
-        # This is a hack to execute job.get_config in a thread retrying many times
-        # because it seems to hang there consistently.
-        event = threading.Event()
-
-        class T(threading.Thread):
-
-            def run(self):
-                self.config = job.get_config()
-                event.set()
-
-        for i in xrange(5):
-            t = T()
-            t.setDaemon(True)
-            t.start()
-            event.wait(3)
-            if hasattr(t, 'config'):
-                return t.config
-            print 'Unable to get job xml. Retrying... (%s of 5)' % (i+1,)
-
-        raise AssertionError('Error: unable to get the config for the job: %s' % (job,))
-
+        return job_name in job_names
 
 
     jobs_created = []
@@ -676,9 +2639,9 @@ def server_jobs_link(args, global_config, opts):
                     print job_name, 'after', previous_job
                     if not apply_changes:
                         continue
-                    job = jenkins.get_job(previous_job)
+                    job = JenkinsJob(jenkins, previous_job)
                     jobs_created.append(job)
-                    xml_config = GetXmlConfig(job)
+                    xml_config = job.get_config()
                     if job_name in xml_config:
                         print 'Skipping (already previously set)'
                         continue
@@ -729,25 +2692,190 @@ def server_jobs_link(args, global_config, opts):
 #===================================================================================================
 # get_job_status
 #===================================================================================================
-def get_job_status(job_name, job, job_index=None):
-    try:
-        build = job.get_last_build()
-    except:
-        status = 'NONE'
-        if job.is_running():
-            status = 'Running'
+def get_job_status(job_entry, job_index=None):
+    '''
+    Formats the status line of a job.
+
+    :param dict job_entry:
+        The job, as an entry of the job index (see JenkinsClient.get_job_index); a job with no
+        "color" is considered missing from the server.
+    '''
+    last_build = job_entry.get('lastBuild')
+    if last_build is None:
         timestamp = '-'
     else:
-        if build.is_running():
-            status = 'RUNNING'
-        else:
-            status = build.get_status()
-        # get_timestamp - the number of milliseconds since January 1, 1970, 00:00:00 GMT represented by this date.
-        timestamp = str(time.ctime(build.get_timestamp() / 1000.0))
+        # timestamp - the number of milliseconds since January 1, 1970, 00:00:00 GMT represented by this date.
+        timestamp = str(time.ctime(last_build['timestamp'] / 1000.0))
 
     if job_index is None:
         job_index = ''
-    return '%2s - %-55s | %10s (%25s)' % (job_index, job_name, status, timestamp)
+    return '%2s - %-55s | %10s (%25s)' % (job_index, job_entry['name'], get_job_state(job_entry), timestamp)
+
+
+#===================================================================================================
+# get_job_state
+#===================================================================================================
+def get_job_state(job_entry):
+    '''
+    :param dict job_entry:
+        See get_job_status.
+
+    :return str:
+        The result of the last build of the job ("SUCCESS", "FAILURE", etc), "RUNNING" if it is
+        building, "NONE" if it was never built and "NOT FOUND" if it is missing from the server.
+    '''
+    last_build = job_entry.get('lastBuild')
+    if last_build is None:
+        if job_entry['color'] is None:
+            return 'NOT FOUND'
+        elif job_entry['color'].endswith('_anime'):
+            return 'Running'
+        else:
+            return 'NONE'
+    elif last_build['building']:
+        return 'RUNNING'
+    else:
+        return last_build['result']
+
+
+#===================================================================================================
+# get_job_record
+#===================================================================================================
+JOB_RECORD_FIELDS = ['name', 'status', 'color', 'number', 'timestamp', 'url']
+
+def get_job_record(jenkins, job_entry):
+    '''
+    :param dict job_entry:
+        See get_job_status.
+
+    :return dict:
+        The fields of JOB_RECORD_FIELDS for the job, as written by RecordWriter: "number" and
+        "timestamp" (milliseconds since the epoch) are those of the last build, if any.
+    '''
+    last_build = job_entry.get('lastBuild') or {}
+    return {
+        'name' : job_entry['name'],
+        'status' : get_job_state(job_entry),
+        'color' : job_entry.get('color'),
+        'number' : last_build.get('number'),
+        'timestamp' : last_build.get('timestamp'),
+        'url' : jenkins.get_job_url(job_entry['name']),
+    }
+
+
+#===================================================================================================
+# watch_jobs_status
+#===================================================================================================
+WATCH_MAX_INTERVAL = 60
+
+def watch_jobs_status(jenkins, get_job_entries, interval, stream=None, max_rounds=None,
+    record_writer=None):
+    '''
+    Keeps showing the status of jobs (as get_job_status) until interrupted.
+
+    Each update obtains the status of all jobs with a single request (see
+    JenkinsClient.get_job_index), and only the lines of the jobs whose status changed are written
+    again. While no job is building, the time between updates doubles up to WATCH_MAX_INTERVAL.
+
+    :param callable get_job_entries:
+        Receives the job index and returns the entries of the jobs to show.
+
+    :param float interval:
+        Seconds between updates while jobs are building.
+
+    :param stream:
+        File-like object where the status is written; defaults to sys.stdout. Unless it is a
+        terminal supporting ANSI escape codes, lines of jobs that changed are just written again
+        after the others.
+
+    :param int max_rounds:
+        Number of updates until returning; by default never returns.
+
+    :param RecordWriter record_writer:
+        If given, a record (see get_job_record) is written for every job on the first update and
+        then for each job whose status changed, instead of lines in `stream`; errors go to stderr.
+    '''
+    import urllib2
+
+    if stream is None:
+        stream = sys.stdout
+    in_place = hasattr(stream, 'isatty') and stream.isatty() and sys.platform != 'win32'
+    if record_writer is not None:
+        in_place = False
+
+    lines = []
+    current_interval = interval
+    rounds = 0
+    while max_rounds is None or rounds < max_rounds:
+        if rounds > 0:
+            time.sleep(current_interval)
+        rounds += 1
+
+        try:
+            job_entries = get_job_entries(jenkins.get_job_index(refresh=True))
+        except urllib2.URLError, e:
+            error_stream = stream
+            if record_writer is not None:
+                error_stream = sys.stderr
+            print >> error_stream, 'error: %s (retrying in %d seconds)' % (e, current_interval)
+            # start over below the message
+            lines = []
+            current_interval = min(current_interval * 2, max(interval, WATCH_MAX_INTERVAL))
+            continue
+
+        new_lines = [get_job_status(job_entry, index) for index, job_entry in enumerate(job_entries)]
+        if len(new_lines) != len(lines):
+            # jobs added or removed: write all of them again
+            if in_place and lines:
+                stream.write('\x1b[%dA\r\x1b[J' % len(lines))
+            changed_indexes = range(len(new_lines))
+        else:
+            changed_indexes = [
+                index for index, (line, new_line) in enumerate(zip(lines, new_lines))
+                if line != new_line
+            ]
+        changed = bool(changed_indexes)
+        for index in changed_indexes:
+            if record_writer is not None:
+                record_writer.write(get_job_record(jenkins, job_entries[index]))
+            elif in_place and len(lines) == len(new_lines):
+                up = len(lines) - index
+                stream.write('\x1b[%dA\r\x1b[K%s\x1b[%dB\r' % (up, new_lines[index], up))
+            else:
+                stream.write(new_lines[index] + '\n')
+        stream.flush()
+        lines = new_lines
+
+        building = [
+            job_entry for job_entry in job_entries
+            if (job_entry.get('color') or '').endswith('_anime') or
+            (job_entry.get('lastBuild') or {}).get('building')
+        ]
+        if building or changed:
+            current_interval = interval
+        else:
+            current_interval = min(current_interval * 2, max(interval, WATCH_MAX_INTERVAL))
+
+
+#===================================================================================================
+# match_jobs
+#===================================================================================================
+def match_jobs(job_index, pattern, use_re=False):
+    '''
+    Filters the entries of a job index whose names match the given pattern.
+
+    :param bool use_re:
+        If True the pattern is a regular expression, otherwise an Unix filename pattern.
+
+    :rtype: list(dict)
+    '''
+    if use_re:
+        regex = re.compile(pattern)
+        match = regex.match
+    else:
+        match = lambda job_name: fnmatch.fnmatch(job_name, pattern)
+
+    return [job_entry for job_entry in job_index if match(job_entry['name'])]
 
 
 #===================================================================================================
@@ -770,6 +2898,11 @@ class JobInfo(object):
         else:
             self.config_filename = None
 
+        # set by "sv.up" when the job already exists in the server (and its configuration is the
+        # same as the local one)
+        self.update = False
+        self.unchanged = False
+
     def BaseName(self):
         '''
         :return str: The job name without it's index
@@ -791,7 +2924,7 @@ class JobInfo(object):
 # server_upload_jobs
 #===================================================================================================
 reindex_opt = opt('--reindex', default=False, action='store_true', help='reindexes jobs')
-@app(alias='sv.up', usage='<directory>', opts=[reindex_opt])
+@app(alias='sv.up', usage='<directory>', opts=[reindex_opt, jobs_option])
 def server_upload_jobs(args, global_config, opts):
     '''
     Uploads jobs found in a directory directly to jenkins.
@@ -806,7 +2939,8 @@ def server_upload_jobs(args, global_config, opts):
                 /config.xml
 
     Executing "cit server_upload_jobs source-dir" will upload "job-1" and "job-2" to jenkins,
-    creating or updating them.
+    creating or updating them. Jobs whose configuration in jenkins is already the same as the local
+    one are not updated.
     '''
     if not args:
         print >> sys.stderr, "error: Must pass a directory name"
@@ -819,6 +2953,8 @@ def server_upload_jobs(args, global_config, opts):
 
 
     jenkins = create_jenkins(global_config)
+    # decides whether each job is created or updated, so a cached job index is not good enough
+    remote_job_names = set(job_entry['name'] for job_entry in jenkins.get_job_index(refresh=True))
 
     search_pattern = None
     local_jobs = []
@@ -838,7 +2974,7 @@ def server_upload_jobs(args, global_config, opts):
             elif search_pattern != job_info.SearchPattern():
                 raise ValueError('Bad job names pattern: %r != %r' % (search_pattern, job_info.SearchPattern()))
 
-        job_info.update = jenkins.has_job(job_info.name)
+        job_info.update = job_info.name in remote_job_names
         local_jobs.append(job_info)
 
     rename_jobs = {}
@@ -847,141 +2983,800 @@ def server_upload_jobs(args, global_config, opts):
         remote_jobs = get_remote_job_infos(search_pattern, global_config, jenkins=jenkins)
         remote_basenames = dict((ji.BaseName(), ji) for ji in remote_jobs)
 
-        for job_info in local_jobs:
-            base_name = job_info.BaseName()
-            remote_job = remote_basenames.pop(base_name, None)
-            if remote_job is not None and remote_job.name != job_info.name:
-                rename_jobs[job_info.name] = remote_job.name
+        for job_info in local_jobs:
+            base_name = job_info.BaseName()
+            remote_job = remote_basenames.pop(base_name, None)
+            if remote_job is not None and remote_job.name != job_info.name:
+                rename_jobs[job_info.name] = remote_job.name
+
+        delete_jobs = [ji.name for ji in remote_basenames.itervalues()]
+
+    # jobs whose configuration in the server is already the same as the local one are left alone
+    def is_unchanged(job_info):
+        local_config = file(job_info.config_filename).read()
+        remote_config = JenkinsJob(jenkins, job_info.name).get_config()
+        return canonicalize_xml(local_config) == canonicalize_xml(remote_config)
+
+    existing_jobs = [ji for ji in local_jobs if ji.update and ji.name not in rename_jobs]
+    for job_info, unchanged, _ in imap_in_threads(is_unchanged, existing_jobs, opts.jobs):
+        # when the configurations can't be compared the job is uploaded anyway
+        job_info.unchanged = bool(unchanged)
+
+    upload_jobs = [ji for ji in local_jobs if not ji.unchanged]
+    for job_info in upload_jobs:
+        if job_info.name in rename_jobs:
+            print 'Renaming %r -> %r' % (rename_jobs[job_info.name], job_info.name)
+
+        elif job_info.update:
+            print 'Updating %r' % job_info.name
+        else:
+            print 'Creating %r' % job_info.name
+
+    for job_name in delete_jobs:
+        print
+        print 'Deleting %r' % job_name
+        print
+
+    unchanged_count = len(local_jobs) - len(upload_jobs)
+    if unchanged_count:
+        print 'Unchanged: %d job(s)' % unchanged_count
+
+    if len(upload_jobs) > 0 or len(delete_jobs) > 0:
+        ans = raw_input('Update jobs (y|*n): ')
+        if ans.startswith('y'):
+            def upload(job_info):
+                config_xml = file(job_info.config_filename).read()
+
+                if job_info.name in rename_jobs:
+                    remote_name = rename_jobs[job_info.name]
+                    JenkinsJob(jenkins, remote_name).update_config(config_xml)
+                    jenkins.rename_job(remote_name, job_info.name)
+                    return 'RENAMED'
+                elif job_info.update:
+                    JenkinsJob(jenkins, job_info.name).update_config(config_xml)
+                    return 'UPDATED'
+                else:
+                    jenkins.create_job(job_info.name, config_xml)
+                    return 'CREATED'
+
+            counts = dict.fromkeys(['CREATED', 'UPDATED', 'RENAMED', 'DELETED', 'FAILED'], 0)
+            for job_info, status, error in imap_in_threads(upload, upload_jobs, opts.jobs):
+                if error is not None:
+                    status = 'FAILED'
+                    print '%s (FAILED: %s)' % (job_info.name, error)
+                else:
+                    print '%s (%s)' % (job_info.name, status)
+                counts[status] += 1
+
+            for job_name, _, error in imap_in_threads(jenkins.delete_job, delete_jobs, opts.jobs):
+                if error is not None:
+                    counts['FAILED'] += 1
+                    print '%s (FAILED: %s)' % (job_name, error)
+                else:
+                    counts['DELETED'] += 1
+                    print '%s (DELETED)' % job_name
+
+            counts['UNCHANGED'] = unchanged_count
+            print
+            print ('Created: %(CREATED)d, Updated: %(UPDATED)d, Renamed: %(RENAMED)d, '
+                'Deleted: %(DELETED)d, Unchanged: %(UNCHANGED)d, Failed: %(FAILED)d' % counts)
+            if counts['FAILED']:
+                return 1
+
+
+#===================================================================================================
+# server_download_jobs
+#===================================================================================================
+download_jobs_opts = [
+    re_option,
+    refresh_option,
+    jobs_option,
+    opt('--incremental', default=False, action='store_true',
+        help='leave untouched the local configurations that are the same as in the server'),
+    yes_option,
+]
+@app(alias='sv.down', usage='<pattern> [directory] [options]', opts=download_jobs_opts)
+def server_download_jobs(args, opts, global_config):
+    '''
+    Downloads jobs from jenkins whose name match the given pattern (fnmatch or regex style).
+
+    If the directory is not given, it will default to "."
+
+    With "--incremental" only the jobs whose configuration differ from the one already in the
+    directory are written, which makes it cheap to keep a directory in sync with the server.
+    '''
+    if len(args) < 1:
+        print >> sys.stderr, 'error: Missing pattern argument'
+        return 2
+
+    pattern = args[0]
+
+    if len(args) > 1:
+        directory = args[1]
+    else:
+        directory = '.'
+
+    jenkins, jobs_to_download = list_jobs([pattern], global_config, opts)
+
+    print 'Found: %d jobs' % len(jobs_to_download)
+    if not opts.yes:
+        ans = raw_input("Download jobs?(y|*n): ")
+        if not ans.lower().startswith('y'):
+            return
+
+    directory = directory or 'hudson'
+
+    def download(job_to_download):
+        jobname, job = job_to_download
+        job_dir = os.path.join(directory, jobname)
+        if not os.path.isdir(job_dir):
+            os.makedirs(job_dir)
+        xml_filename = os.path.join(job_dir, 'config.xml')
+
+        # the configuration is streamed to a temporary file, only replacing the current one when
+        # the download is complete
+        temp_filename = xml_filename + '.download'
+        try:
+            f = file(temp_filename, 'w')
+            try:
+                job.download_config(f)
+            finally:
+                f.close()
+
+            if os.path.isfile(xml_filename):
+                if opts.incremental and get_file_hash(xml_filename) == get_file_hash(temp_filename):
+                    return 'UNCHANGED'
+                os.remove(xml_filename)
+            os.rename(temp_filename, xml_filename)
+            return 'DOWNLOADED'
+        finally:
+            if os.path.isfile(temp_filename):
+                os.remove(temp_filename)
+
+    counts = dict.fromkeys(['DOWNLOADED', 'UNCHANGED', 'FAILED'], 0)
+    for (jobname, _), status, error in imap_in_threads(download, jobs_to_download, opts.jobs):
+        if error is not None:
+            status = 'FAILED'
+            print '%s (FAILED: %s)' % (jobname, error)
+        else:
+            print '%s (%s)' % (jobname, status)
+        counts[status] += 1
+
+    print
+    print 'Downloaded: %(DOWNLOADED)d, Unchanged: %(UNCHANGED)d, Failed: %(FAILED)d' % counts
+    if counts['FAILED']:
+        return 1
+
+
+#===================================================================================================
+# get_remote_job_infos
+#===================================================================================================
+def get_remote_job_infos(pattern, global_config, use_re=False, jenkins=None):
+    '''
+    :param jenkins:
+    '''
+    if jenkins is None:
+        jenkins = create_jenkins(global_config)
+
+    return [
+        JobInfo(job_entry['name'])
+        for job_entry in match_jobs(jenkins.get_job_index(), pattern, use_re)
+    ]
+
+
+#===================================================================================================
+# server_rm_jobs
+#===================================================================================================
+@app(alias='sv.rm', usage='<pattern> [options]',
+    opts=[re_option, jobs_option, dry_run_option, yes_option])
+def server_rm_jobs(args, opts, global_config):
+    '''
+    Deletes the jobs whose name match a given pattern.
+    '''
+    if len(args) < 1:
+        print >> sys.stderr, 'error: missing pattern'
+        return 2
+
+    jenkins = create_jenkins(global_config, authenticate=not opts.dry_run)
+    # never delete jobs based on a cached list of jobs
+    job_index = jenkins.get_job_index(refresh=True)
+    job_names = [job_entry['name'] for job_entry in match_jobs(job_index, args[0], opts.re)]
+
+    if not opts.dry_run and not opts.yes:
+        for job_name in job_names:
+            print '\t', job_name
+        print 'Found: %d jobs' % len(job_names)
+        if not job_names:
+            return
+        ans = raw_input("Delete jobs?(y|*n): ")
+        if not ans.startswith('y'):
+            return
+
+    if remove_jobs(jenkins, job_names, opts.jobs, opts.dry_run):
+        return 1
+
+
+#===================================================================================================
+# server_mv_jobs
+#===================================================================================================
+@app(alias='sv.mv', usage='<pattern> <old> <new> [options]',
+    opts=[re_option, jobs_option, dry_run_option, yes_option, format_option])
+def server_mv_jobs(args, opts, global_config):
+    '''
+    Renames the jobs whose name match a given pattern, replacing <old> by <new> in their names.
+
+    Jobs are renamed in parallel with "--jobs N"; jobs whose new name is already taken by another
+    job, or would be given to other jobs too, are not renamed (and reported as errors).
+
+    With "--format" a record is written for each job, with its "name", "new_name", "status" and
+    "error"; it can only be used without confirmation ("--yes" or "--dry-run").
+    '''
+    if len(args) != 3:
+        print >> sys.stderr, 'error: expected <pattern> <old> <new>'
+        return 2
+    if opts.format != 'text' and not opts.dry_run and not opts.yes:
+        print >> sys.stderr, 'error: --format requires --yes or --dry-run'
+        return 2
+    pattern, old, new = args
+
+    jenkins = create_jenkins(global_config, authenticate=not opts.dry_run)
+    job_index = jenkins.get_job_index(refresh=True)
+    existing_jobs = set(job_entry['name'] for job_entry in job_index)
+    records = [
+        {'name' : job_entry['name'], 'new_name' : job_entry['name'].replace(old, new)}
+        for job_entry in match_jobs(job_index, pattern, opts.re)
+        if old in job_entry['name']
+    ]
+
+    if not opts.dry_run and not opts.yes:
+        for record in records:
+            print '\t%(name)s -> %(new_name)s' % record
+        print 'Found: %d jobs' % len(records)
+        if not records:
+            return
+        ans = raw_input("Rename jobs?(y|*n): ")
+        if not ans.startswith('y'):
+            return
+
+    # jobs that would end up with the same name are not renamed at all
+    new_name_counts = {}
+    for record in records:
+        new_name_counts[record['new_name']] = new_name_counts.get(record['new_name'], 0) + 1
+
+    def rename(record):
+        if record['new_name'] in existing_jobs:
+            raise ValueError('job %s already exists' % record['new_name'])
+        if new_name_counts[record['new_name']] > 1:
+            raise ValueError('%d jobs would be renamed to %s' % (
+                new_name_counts[record['new_name']], record['new_name']))
+        if opts.dry_run:
+            return 'WOULD BE RENAMED'
+        jenkins.rename_job(record['name'], record['new_name'])
+        return 'RENAMED'
+
+    record_writer = create_record_writer(opts, ['name', 'new_name', 'status', 'error'])
+    failures = apply_to_jobs(rename, records, opts.jobs, record_writer,
+        describe=lambda record: '%(name)s -> %(new_name)s' % record)
+    if record_writer is not None:
+        record_writer.finish()
+    if failures:
+        return 1
+
+
+#===================================================================================================
+# server_start_jobs
+#===================================================================================================
+@app(alias='sv.start', usage='<pattern> [options]',
+    opts=[re_option, jobs_option, dry_run_option, yes_option, format_option])
+def server_start_jobs(args, opts, global_config):
+    '''
+    Starts the jobs whose name match a given pattern, except those already running.
+
+    Jobs are started in parallel with "--jobs N". With "--format" a record is written for each
+    job, with its "name", "status" and "error"; it can only be used without confirmation ("--yes"
+    or "--dry-run").
+    '''
+    if len(args) != 1:
+        print >> sys.stderr, 'error: expected a pattern'
+        return 2
+    if opts.format != 'text' and not opts.dry_run and not opts.yes:
+        print >> sys.stderr, 'error: --format requires --yes or --dry-run'
+        return 2
+
+    jenkins = create_jenkins(global_config, authenticate=not opts.dry_run)
+    job_index = jenkins.get_job_index(refresh=True)
+    job_entries = match_jobs(job_index, args[0], opts.re)
+
+    if not opts.dry_run and not opts.yes:
+        for job_entry in job_entries:
+            print '\t', job_entry['name']
+        print 'Found: %d jobs' % len(job_entries)
+        if not job_entries:
+            return
+        ans = raw_input("Start jobs?(y|*n): ")
+        if not ans.startswith('y'):
+            return
+
+    # running jobs are known from the index, so only the jobs started need a request
+    running_jobs = set(
+        job_entry['name'] for job_entry in job_entries if get_job_state(job_entry) == 'RUNNING')
+
+    def start(record):
+        if record['name'] in running_jobs:
+            return 'RUNNING'
+        if opts.dry_run:
+            return 'WOULD BE STARTED'
+        JenkinsJob(jenkins, record['name']).invoke()
+        return 'STARTED'
+
+    record_writer = create_record_writer(opts, ['name', 'status', 'error'])
+    records = [{'name' : job_entry['name']} for job_entry in job_entries]
+    failures = apply_to_jobs(start, records, opts.jobs, record_writer)
+    if record_writer is not None:
+        record_writer.finish()
+    if failures:
+        return 1
+
+
+#===================================================================================================
+# remove_jobs
+#===================================================================================================
+REMOVE_RECORD_FIELDS = ['name', 'status', 'error']
+
+def remove_jobs(jenkins, job_names, workers, dry_run=False, record_writer=None):
+    '''
+    Deletes jobs from the server, up to `workers` at the same time, reporting the result of each
+    one (see apply_to_jobs).
+
+    Jobs that don't exist anymore when deleted are reported as "NOT FOUND", not as failures.
+
+    :param bool dry_run:
+        Only report the jobs that would be deleted: those in the job index of `jenkins` (which
+        should have been refreshed), the others are reported as "NOT FOUND".
+
+    :param RecordWriter record_writer:
+        If given, the result of each job is written as a record (with the REMOVE_RECORD_FIELDS).
+
+    :return int: the number of jobs that could not be deleted.
+    '''
+    import urllib2
+
+    if dry_run:
+        existing_jobs = set(job_entry['name'] for job_entry in jenkins.get_job_index())
+
+    def remove(record):
+        if dry_run:
+            if record['name'] not in existing_jobs:
+                return 'NOT FOUND'
+            return 'WOULD BE REMOVED'
+        try:
+            jenkins.delete_job(record['name'])
+        except urllib2.HTTPError, e:
+            if e.code == 404:
+                return 'NOT FOUND'
+            raise
+        return 'REMOVED'
+
+    records = [{'name' : job_name} for job_name in job_names]
+    return apply_to_jobs(remove, records, workers, record_writer)
+
+
+#===================================================================================================
+# apply_to_jobs
+#===================================================================================================
+def apply_to_jobs(function, records, workers, record_writer=None, describe=None):
+    '''
+    Applies an operation to many jobs, up to `workers` at the same time, printing the status of
+    each one in the given order and a summary at the end.
+
+    :param callable function:
+        Receives the record of a job and returns its status (like "STARTED"); if it raises an
+        exception the status is "ERROR", and the exception is the "error" of the record.
+
+    :param list(dict) records:
+        A record for each job, with its "name" at least.
+
+    :param RecordWriter record_writer:
+        If given, the records (with their "status" and "error") are written with it instead, and
+        the summary is printed to stderr.
+
+    :param callable describe:
+        Returns how a record is shown in the text output; by default, the name of its job.
+
+    :return int: the number of jobs whose operation failed.
+    '''
+    if describe is None:
+        describe = lambda record: record['name']
+    if record_writer is None:
+        summary_stream = sys.stdout
+    else:
+        summary_stream = sys.stderr
+
+    statuses = []
+    counts = {}
+    for record, status, error in imap_in_threads(function, records, workers):
+        if error is not None:
+            status = 'ERROR'
+            record['error'] = str(error)
+        record['status'] = status
+
+        if record_writer is not None:
+            record_writer.write(record)
+        elif error is not None:
+            print '%s (ERROR: %s)' % (describe(record), error)
+        else:
+            print '%s (%s)' % (describe(record), status)
+        sys.stdout.flush()
+
+        if status not in counts:
+            statuses.append(status)
+            counts[status] = 0
+        counts[status] += 1
+
+    if statuses:
+        print >> summary_stream, ', '.join(
+            '%s: %d' % (status.capitalize(), counts[status]) for status in statuses)
+    failures = counts.get('ERROR', 0)
+    if failures:
+        print >> sys.stderr, 'error: %d of %d job(s) failed' % (failures, len(records))
+    return failures
+
+
+#===================================================================================================
+# Batch Commands
+# --------------
+#
+# Commands that execute other cit commands.
+#
+#===================================================================================================
+
+#===================================================================================================
+# cit_batch
+#===================================================================================================
+@app(alias='batch', usage='[file] [options]')
+def cit_batch(args, app):
+    '''
+    Executes many commands read from a file (or stdin) in a single session.
+
+    Each line contains a command as it would be given to cit (like "fb.add my_branch") or as JSON,
+    either a list of arguments or an object with "argv" and optionally "cwd", the directory where the
+    command is executed. Empty lines and lines starting with "#" are ignored.
+
+    All commands share the same Jenkins client, so authentication, connections and the job list
+    are obtained only once. Commands can't prompt the user for input.
+
+    The result of each command is printed as a JSON object in a line, as soon as it finishes.
+    '''
+    if len(args) > 1:
+        print >> sys.stderr, 'error: expected at most one file'
+        return 2
+
+    if args and args[0] != '-':
+        input_file = file(args[0])
+    else:
+        input_file = sys.stdin
+
+    failed = 0
+    executed = 0
+    try:
+        with shared_jenkins_clients():
+            for line_number, line in enumerate(input_file):
+                try:
+                    command = parse_batch_command(line)
+                except ValueError, e:
+                    command = {'argv' : None, 'cwd' : None}
+                    error = 'line %d: %s' % (line_number + 1, e)
+                    result = {'exit_code' : 2, 'output' : '', 'error' : error}
+                else:
+                    if command is None:
+                        continue
+                    result = run_batch_command(app, command['argv'], command['cwd'])
+
+                result.update(command)
+                executed += 1
+                if result['exit_code'] != 0:
+                    failed += 1
+                print json.dumps(result, sort_keys=True)
+                sys.stdout.flush()
+    finally:
+        if input_file is not sys.stdin:
+            input_file.close()
+
+    if failed:
+        print >> sys.stderr, 'error: %d of %d command(s) failed' % (failed, executed)
+        return 1
+
+
+#===================================================================================================
+# parse_batch_command
+#===================================================================================================
+def parse_batch_command(line):
+    '''
+    Parses a line of the input of "cit batch".
 
-        delete_jobs = [ji.name for ji in remote_basenames.itervalues()]
+    :return dict:
+        With the "argv" of the command and its "cwd" (None for the current directory), or None if
+        the line has no command.
 
-    for job_info in local_jobs:
-        if job_info.name in rename_jobs:
-            print 'Renaming %r -> %r' % (rename_jobs[job_info.name], job_info.name)
+    :raise ValueError: if the line is not valid.
+    '''
+    line = line.strip()
+    if not line or line.startswith('#'):
+        return None
 
-        elif job_info.update:
-            print 'Updating %r' % job_info.name
+    cwd = None
+    if line[0] in '[{':
+        command = json.loads(line)
+        if isinstance(command, dict):
+            cwd = command.get('cwd')
+            argv = command.get('argv')
         else:
-            print 'Creating %r' % job_info.name
+            argv = command
+        if not isinstance(argv, list) or not argv:
+            raise ValueError('expected a list of arguments')
+        argv = [unicode(arg).encode('utf-8') for arg in argv]
+    else:
+        argv = shlex.split(line)
 
-    for job_name in delete_jobs:
-        print
-        print 'Deleting %r' % job_name
-        print
+    # allow lines copied from scripts
+    if argv[0] == 'cit':
+        argv = argv[1:]
+    if not argv:
+        raise ValueError('no command given')
+    if argv[0] == 'batch':
+        raise ValueError('batch commands can\'t be nested')
+    return {'argv' : argv, 'cwd' : cwd}
 
-    if len(local_jobs) > 0:
-        ans = raw_input('Update jobs (y|*n): ')
-        if ans.startswith('y'):
-            for job_info in local_jobs:
-                config_xml = file(job_info.config_filename).read()
 
-                if job_info.name in rename_jobs:
-                    remote_name = rename_jobs[job_info.name]
-                    print '\tUpdating job'
-                    job = jenkins.get_job(remote_job.name)
-                    job.update_config(config_xml)
+#===================================================================================================
+# run_batch_command
+#===================================================================================================
+def run_batch_command(app, argv, cwd=None):
+    '''
+    Executes a command, capturing its output.
 
-                    print 'Renaming %r -> %r' % (remote_name, job_info.name)
-                    jenkins.rename_job(remote_name, job_info.name)
+    :param list(str) argv:
+        The command and its arguments.
 
-                else:
-                    if job_info.update:
-                        print 'Updating %r' % job_info.name
-                        job = jenkins.get_job(job_info.name)
-                        job.update_config(config_xml)
-                    else:
-                        print 'Creating %r' % job_info.name
-                        job = jenkins.create_job(job_info.name, config_xml)
+    :param str cwd:
+        Directory where the command is executed; by default the current one.
 
-            for job_name in delete_jobs:
-                print 'Deleting %r' % job_name
-                job = jenkins.delete_job(job_name)
+    :return dict:
+        With the "exit_code" of the command, its "output" (stdout and stderr), "elapsed" time in
+        seconds and, if the command raised an exception, the "error" traceback.
+    '''
+    result = {}
+    output = StringIO.StringIO()
+    previous_cwd = os.getcwd()
+    previous_streams = sys.stdin, sys.stdout, sys.stderr
+    start = time.time()
+    try:
+        sys.stdout = sys.stderr = output
+        # commands can't prompt the user: they get an end of file instead
+        sys.stdin = StringIO.StringIO()
+        try:
+            if cwd:
+                os.chdir(cwd)
+            # only the connections are shared with previous commands, not their retries
+            for transport in _transports.itervalues():
+                transport.reset_retry_budget()
+            exit_code = app.main(argv)
+        except SystemExit, e:
+            exit_code = e.code
+        except ConfigError, e:
+            exit_code = 1
+            result['error'] = str(e)
+        except Exception:
+            exit_code = 1
+            result['error'] = traceback.format_exc()
+    finally:
+        sys.stdin, sys.stdout, sys.stderr = previous_streams
+        os.chdir(previous_cwd)
+
+    result['exit_code'] = exit_code or 0
+    result['output'] = output.getvalue()
+    result['elapsed'] = round(time.time() - start, 3)
+    return result
 
 
 #===================================================================================================
-# server_download_jobs
+# cit_serve
 #===================================================================================================
-@app(alias='sv.down', usage='<pattern> [directory] [options]', opts=[re_option])
-def server_download_jobs(args, opts, global_config):
+# commands that can be executed by the daemon, as they never prompt the user; the flag tells
+# whether they change jobs, so the job index kept by the daemon must be discarded after them
+DAEMON_COMMANDS = {
+    'fb.add' : True,
+    'fb.rm' : True,
+    'fb.start' : True,
+    'sv.ls' : False,
+}
+
+@app(alias='serve')
+def cit_serve(global_config, app):
     '''
-    Downloads jobs from jenkins whose name match the given pattern (fnmatch or regex style).
+    Executes commands forwarded by other cit invocations.
 
-    If the directory is not given, it will default to "."
+    Listens on a local socket (see get_daemon_socket_file) keeping the Jenkins client, connections,
+    job list and configuration files in memory, so commands forwarded to it don't have to obtain
+    them again. While it is running, invocations of commands that never prompt the user (fb.add,
+    fb.rm, fb.start and sv.ls) are executed by it. Stop it with Ctrl+C.
     '''
-    if len(args) < 1:
-        print >> sys.stderr, 'error: Missing pattern argument'
-        return 2
+    import socket
 
-    pattern = args[0]
+    if not hasattr(socket, 'AF_UNIX'):
+        print >> sys.stderr, 'error: serve is not supported on this platform'
+        return 1
 
-    if len(args) > 1:
-        directory = args[1]
-    else:
-        directory = '.'
+    socket_file = get_daemon_socket_file()
+    if os.path.exists(socket_file):
+        if connect_to_daemon(socket_file) is not None:
+            print >> sys.stderr, 'error: cit is already being served at %s' % socket_file
+            return 1
+        # left behind by a daemon that didn't exit cleanly
+        os.remove(socket_file)
 
-    jenkins, jobs_to_download = server_list_jobs([pattern], global_config, opts)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        server.bind(socket_file)
+        os.chmod(socket_file, 0600)
+        server.listen(5)
+
+        with shared_jenkins_clients():
+            # authenticates now, as forwarded commands can't prompt the user
+            create_jenkins(global_config, authenticate=True)
+            print 'Serving cit at %s' % socket_file
+            sys.stdout.flush()
+            while True:
+                connection = server.accept()[0]
+                try:
+                    serve_daemon_request(app, connection)
+                except socket.error, e:
+                    print >> sys.stderr, 'error: %s' % e
+                finally:
+                    connection.close()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        if os.path.exists(socket_file):
+            os.remove(socket_file)
 
-    print 'Found: %d jobs' % len(jobs_to_download)
-    ans = raw_input("Download jobs?(y|*n): ")
 
-    if not ans.lower().startswith('y'):
-        return
+#===================================================================================================
+# serve_daemon_request
+#===================================================================================================
+def serve_daemon_request(app, connection):
+    '''
+    Executes a command received from a connection to the daemon: a JSON object in a line with the
+    "argv" and "cwd" of the command. The result (see run_batch_command) is sent back also as a JSON
+    object in a line.
+    '''
+    stream = connection.makefile('rwb')
+    try:
+        line = stream.readline()
+        if not line:
+            # just checking whether the daemon is running
+            return
+        try:
+            request = json.loads(line)
+            argv = [arg.encode('utf-8') for arg in request['argv']]
+            cwd = request['cwd']
+        except (ValueError, KeyError, TypeError, AttributeError), e:
+            result = {'exit_code' : 2, 'output' : '', 'error' : 'invalid request: %s' % e}
+        else:
+            if is_daemon_command(argv):
+                drop_stale_job_indexes()
+                result = run_batch_command(app, argv, cwd)
+                if DAEMON_COMMANDS[argv[0]]:
+                    for jenkins in _shared_clients.values():
+                        jenkins.invalidate_job_index()
+            else:
+                result = {'exit_code' : 2, 'output' : '', 'error' : 'command not served: %s' % argv}
+        stream.write(json.dumps(result) + '\n')
+        stream.flush()
+    finally:
+        stream.close()
 
-    directory = directory or 'hudson'
-    if not os.path.exists(directory):
-        os.mkdir(directory)
 
-    for jobname, job in jobs_to_download:
-        print 'Downloading: %r' % jobname
-        job_dir = os.path.join(directory, jobname)
-        os.mkdir(job_dir)
-        xml_filename = os.path.join(job_dir, 'config.xml')
-        job_xml = job.get_config()
-        file(xml_filename, 'w').write(job_xml)
+#===================================================================================================
+# drop_stale_job_indexes
+#===================================================================================================
+def drop_stale_job_indexes():
+    '''
+    Discards job indexes kept in memory by shared clients (see shared_jenkins_clients) that may be
+    outdated: jobs may have been changed by other cit invocations, or the index may have expired.
+    '''
+    for jenkins in _shared_clients.values():
+        if jenkins.job_index_cache is None or not jenkins.job_index_cache.is_current():
+            jenkins._job_index = None
 
 
 #===================================================================================================
-# get_remote_job_infos
+# is_daemon_command
 #===================================================================================================
-def get_remote_job_infos(pattern, global_config, use_re=False, jenkins=None):
+def is_daemon_command(argv):
     '''
-    :param jenkins:
+    :return bool: whether the command given in the command line can be executed by the daemon.
     '''
-    import fnmatch
+    if not argv or argv[0] not in DAEMON_COMMANDS:
+        return False
+    # interactive, waiting for builds, or reporting about the local process
+    local_options = set(
+        ['-i', '--interactive', '-h', '--help', '--wait', '--trace', '--profile'])
+    return not [arg for arg in argv if arg.split('=', 1)[0] in local_options]
 
-    if jenkins is None:
-        jenkins = create_jenkins(global_config)
 
-    regex = re.compile(pattern)
+#===================================================================================================
+# forward_to_daemon
+#===================================================================================================
+def forward_to_daemon(argv):
+    '''
+    Executes a command through the daemon (see cit_serve), if it is running and serves the command.
 
-    def match(job_name):
-        if use_re:
-            return regex.match(job_name)
-        else:
-            return fnmatch.fnmatch(jobname, pattern)
+    Setting the environment variable CIT_NO_DAEMON disables forwarding.
 
-    jobs = []
-    for jobname in jenkins.iterkeys():
-        if match(jobname):
-            jobs.append(JobInfo(jobname))
+    :return int:
+        The exit code of the command, or None if it was not forwarded and must be executed by this
+        process.
+    '''
+    if os.environ.get('CIT_NO_DAEMON') or not is_daemon_command(argv):
+        return None
+    socket_file = get_daemon_socket_file()
+    if not os.path.exists(socket_file):
+        return None
+
+    connection = connect_to_daemon(socket_file)
+    if connection is None:
+        return None
+    stream = connection.makefile('rwb')
+    try:
+        stream.write(json.dumps({'argv' : argv, 'cwd' : os.getcwd()}) + '\n')
+        stream.flush()
+        response = stream.readline()
+    finally:
+        stream.close()
+        connection.close()
+    if not response:
+        # the daemon stopped before finishing the command
+        return None
 
-    return jobs
+    result = json.loads(response)
+    sys.stdout.write(result['output'].encode('utf-8'))
+    if 'error' in result:
+        sys.stderr.write(result['error'].encode('utf-8'))
+    return result['exit_code']
 
 
 #===================================================================================================
-# server_rm_jobs
+# connect_to_daemon
 #===================================================================================================
-@app(alias='sv.rm', usage='<pattern> [directory] [options]', opts=[re_option])
-def server_rm_jobs(args, opts, global_config):
-    jenkins, jobs_to_delete = server_list_jobs(args, global_config, opts, True)
+def connect_to_daemon(socket_file):
+    '''
+    :return socket: connected to the daemon, or None if it is not running.
+    '''
+    import socket
 
-    if len(jobs_to_delete) > 0:
-        print 'Found: %d jobs' % len(jobs_to_delete)
-        ans = raw_input("Delete jobs?(y|*n): ")
-        if ans.startswith('y'):
-            for jobname, job in jobs_to_delete:
-                print 'Deleting: %r' % jobname
-                jenkins.delete_job(jobname)
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(socket_file)
+    except socket.error:
+        connection.close()
+        return None
+    return connection
+
+
+#===================================================================================================
+# get_daemon_socket_file
+#===================================================================================================
+def get_daemon_socket_file():
+    '''
+    Returns the path to the socket where the daemon listens: given by the environment variable
+    CIT_SOCKET, or alongside the global config file.
+    '''
+    socket_file = os.environ.get('CIT_SOCKET')
+    if socket_file is None:
+        socket_file = os.path.join(os.path.dirname(get_global_config_file()), 'cit.sock')
+    return socket_file
 
 
 #===================================================================================================
@@ -996,6 +3791,11 @@ def server_rm_jobs(args, opts, global_config):
 # get_git_user
 #===================================================================================================
 def get_git_user():
+    # reading git files directly is much faster than spawning git, which is used only as fallback
+    user_name, user_email = read_git_user(os.getcwd())
+    if user_name is not None and user_email is not None:
+        return user_name, user_email
+
     try:
         user_name = check_output('git config --get user.name', shell=True).strip()
         user_email = check_output('git config --get user.email', shell=True).strip()
@@ -1005,16 +3805,260 @@ def get_git_user():
         return user_name, user_email
 
 
+#===================================================================================================
+# get_remote_branches
+#===================================================================================================
+def get_remote_branches(remote):
+    '''
+    :return set(str):
+        The names of the branches in the given remote of the repository in the current directory,
+        or None if they could not be obtained.
+    '''
+    try:
+        with trace_phase('git'):
+            output = check_output(['git', 'ls-remote', '--heads', remote])
+    except (subprocess.CalledProcessError, OSError):
+        return None
+
+    branches = set()
+    for line in output.splitlines():
+        ref = line.split('\t')[-1].strip()
+        if ref.startswith('refs/heads/'):
+            branches.add(ref[len('refs/heads/'):])
+    return branches
+
+
 #===================================================================================================
 # get_git_branch
 #===================================================================================================
 def get_git_branch():
+    # reading git files directly is much faster than spawning git, which is used only as fallback
+    branch = read_git_branch(os.getcwd())
+    if branch is not None:
+        return branch
+
     try:
         return check_output('git rev-parse --abbrev-ref HEAD', shell=True).strip()
     except subprocess.CalledProcessError:
         return None
 
 
+#===================================================================================================
+# read_git_branch
+#===================================================================================================
+def read_git_branch(from_dir):
+    '''
+    Reads the current branch of the repository containing the given directory from its HEAD file.
+
+    :return str:
+        The branch name, "HEAD" if it is detached (as "git rev-parse --abbrev-ref HEAD") or None if
+        it could not be determined.
+    '''
+    git_dir = get_git_dirs(from_dir)[0]
+    if git_dir is None:
+        return None
+
+    try:
+        head = file(os.path.join(git_dir, 'HEAD')).read().strip()
+    except IOError:
+        return None
+
+    if head.startswith('ref: refs/heads/'):
+        return head[len('ref: refs/heads/'):]
+    if re.match('[0-9a-f]{40}$', head):
+        return 'HEAD'
+    return None
+
+
+#===================================================================================================
+# read_git_user
+#===================================================================================================
+def read_git_user(from_dir):
+    '''
+    Reads user.name and user.email from the global git configuration and the one of the repository
+    containing the given directory.
+
+    :return tuple(str, str):
+        User name and email; None for values that could not be determined (not configured, set in
+        the system configuration, or using features not supported here).
+    '''
+    git_config = read_git_config(get_git_config_files(from_dir))
+    if git_config is None:
+        return None, None
+    return git_config.get('user.name'), git_config.get('user.email')
+
+
+#===================================================================================================
+# get_git_dirs
+#===================================================================================================
+def get_git_dirs(from_dir):
+    '''
+    Finds the git directory of the repository containing the given directory.
+
+    The ".git" of a working tree may also be a file pointing to the actual git directory
+    ("gitdir: <path>"), as in worktrees and submodules; worktrees also share the configuration of
+    the main repository, found in its "common" directory.
+
+    :return tuple(str, str):
+        The git directory and the common git directory, or (None, None) if not found.
+    '''
+    git_dir = os.environ.get('GIT_DIR')
+    if git_dir is None:
+        git_dir = find_git_directory(from_dir)
+        if git_dir is None:
+            return None, None
+
+    if os.path.isfile(git_dir):
+        contents = file(git_dir).read().strip()
+        if not contents.startswith('gitdir:'):
+            return None, None
+        git_dir = os.path.join(os.path.dirname(git_dir), contents[len('gitdir:'):].strip())
+    git_dir = os.path.normpath(os.path.abspath(git_dir))
+
+    common_dir = git_dir
+    commondir_file = os.path.join(git_dir, 'commondir')
+    if os.path.isfile(commondir_file):
+        common_dir = os.path.join(git_dir, file(commondir_file).read().strip())
+        common_dir = os.path.normpath(common_dir)
+
+    return git_dir, common_dir
+
+
+#===================================================================================================
+# get_git_config_files
+#===================================================================================================
+def get_git_config_files(from_dir):
+    '''
+    :return list(str):
+        The git configuration files that apply to the given directory, by increasing precedence:
+        global files (~/.config/git/config and ~/.gitconfig) and the repository's.
+    '''
+    xdg_config_home = os.environ.get('XDG_CONFIG_HOME') or os.path.expanduser('~/.config')
+    config_files = [
+        os.path.join(xdg_config_home, 'git', 'config'),
+        os.path.expanduser('~/.gitconfig'),
+    ]
+    common_dir = get_git_dirs(from_dir)[1]
+    if common_dir is not None:
+        config_files.append(os.path.join(common_dir, 'config'))
+    return config_files
+
+
+#===================================================================================================
+# read_git_config
+#===================================================================================================
+def read_git_config(filenames, _depth=0):
+    '''
+    Reads git configuration files, following "[include]" directives. Files that don't exist are
+    ignored.
+
+    :return dict:
+        Maps "section.key" (or "section.subsection.key") to the value with the highest precedence;
+        section and key names are lowercase. None if some configuration can't be resolved without
+        git itself (conditional includes, or configuration given in the environment).
+    '''
+    if _depth == 0 and ('GIT_CONFIG_PARAMETERS' in os.environ or 'GIT_CONFIG_COUNT' in os.environ):
+        return None
+
+    result = {}
+    for filename in filenames:
+        if _depth > 10 or not os.path.isfile(filename):
+            continue
+        for name, value in parse_git_config(file(filename).read()):
+            if name.startswith('includeif.'):
+                return None
+            if name == 'include.path' and value:
+                include_file = os.path.expanduser(value)
+                include_file = os.path.join(os.path.dirname(filename), include_file)
+                included = read_git_config([include_file], _depth + 1)
+                if included is None:
+                    return None
+                result.update(included)
+            else:
+                result[name] = value
+    return result
+
+
+#===================================================================================================
+# parse_git_config
+#===================================================================================================
+def parse_git_config(contents):
+    '''
+    Parses the contents of a git configuration file.
+
+    :return list(tuple(str, str)):
+        The ("section.key", value) entries in the order they appear; section and key names are
+        lowercase, keys without values (booleans) have value "true".
+    '''
+    section_regex = re.compile(r'\s*\[\s*([\w.-]+)(?:\s+"((?:[^"\\]|\\.)*)")?\s*\](.*)$')
+    key_regex = re.compile(r'\s*([a-zA-Z][\w-]*)\s*(=?)(.*)$')
+    escapes = {'n' : '\n', 't' : '\t', 'b' : '\b', '"' : '"', '\\' : '\\'}
+
+    entries = []
+    section = None
+    lines = contents.splitlines()
+    while lines:
+        line = lines.pop(0)
+        stripped = line.strip()
+        if not stripped or stripped[0] in '#;':
+            continue
+
+        match = section_regex.match(line)
+        if match is not None:
+            section_name, subsection, line = match.groups()
+            section = section_name.lower()
+            if subsection is not None:
+                section += '.' + re.sub(r'\\(.)', r'\1', subsection)
+            if not line.strip() or line.strip()[0] in '#;':
+                continue
+
+        match = key_regex.match(line)
+        if match is None or section is None:
+            continue
+        key, equals, raw_value = match.groups()
+        if not equals:
+            entries.append(('%s.%s' % (section, key.lower()), 'true'))
+            continue
+
+        value = []
+        pending_space = ''
+        in_quotes = False
+        index = 0
+        while True:
+            if index >= len(raw_value):
+                break
+            char = raw_value[index]
+            index += 1
+            if char == '\\':
+                if index >= len(raw_value):
+                    # line continuation
+                    if not lines:
+                        break
+                    raw_value = lines.pop(0)
+                    index = 0
+                    continue
+                char = raw_value[index]
+                index += 1
+                value.append(pending_space + escapes.get(char, char))
+                pending_space = ''
+            elif char == '"':
+                in_quotes = not in_quotes
+                value.append(pending_space)
+                pending_space = ''
+            elif char in '#;' and not in_quotes:
+                break
+            elif char.isspace() and not in_quotes:
+                # spaces are kept only between words
+                if value:
+                    pending_space += char
+            else:
+                value.append(pending_space + char)
+                pending_space = ''
+        entries.append(('%s.%s' % (section, key.lower()), ''.join(value)))
+
+    return entries
+
+
 #===================================================================================================
 # cit_install
 #===================================================================================================
@@ -1025,6 +4069,9 @@ def cit_install():
 
     This command should be used to configure cit for the first time.
     '''
+    import urllib2
+    import yaml
+
     print '=' * 60
     print 'Configuration'
     print '=' * 60
@@ -1036,7 +4083,7 @@ def cit_install():
     print
     print 'Checking Jenkins server...',
     try:
-        Jenkins(jenkins_url)
+        JenkinsClient(jenkins_url).keys()
     except urllib2.URLError, e:
         print 'ERROR (%s)' % e
     else:
@@ -1075,8 +4122,7 @@ def load_cit_local_config(from_dir):
 
     result = {}
     if os.path.isfile(cit_file_name):
-        loaded_config = yaml.load(file(cit_file_name).read()) or {}
-        result.update(loaded_config)
+        result.update(load_config_file(cit_file_name, LOCAL_CONFIG_SCHEMA))
 
     return cit_file_name, result
 
@@ -1089,7 +4135,8 @@ def find_git_directory(from_dir):
     max_tries = 20
     while True:
         git_dir = os.path.join(from_dir, '.git')
-        if os.path.isdir(git_dir):
+        # ".git" is a file in worktrees and submodules
+        if os.path.exists(git_dir):
             break
         from_dir = os.path.dirname(from_dir)
 
@@ -1108,47 +4155,258 @@ def find_git_directory(from_dir):
 #
 #===================================================================================================
 
+#===================================================================================================
+# LinePrefixWriter
+#===================================================================================================
+class LinePrefixWriter(object):
+    '''
+    File-like object that writes data to another one with a prefix at the start of each line, so
+    the output of many sources can be interleaved. Only complete lines are written; the last
+    incomplete one is kept until it is completed or finish() is called.
+    '''
+
+    def __init__(self, stream, prefix):
+        self.stream = stream
+        self.prefix = prefix
+        self._partial_line = ''
+
+    def write(self, data):
+        lines = (self._partial_line + data).split('\n')
+        self._partial_line = lines.pop()
+        for line in lines:
+            self.stream.write(self.prefix + line + '\n')
+
+    def finish(self):
+        if self._partial_line:
+            self.stream.write(self.prefix + self._partial_line + '\n')
+            self._partial_line = ''
+
+
+#===================================================================================================
+# RecordWriter
+#===================================================================================================
+class RecordWriter(object):
+    '''
+    Writes records (dicts with the same fields) in a machine-readable format, each one as soon as
+    it is given, so tools reading the output can process long listings incrementally:
+
+    * json: a list of objects, closed by finish();
+    * jsonl: an object per line;
+    * csv: a header with the fields, and a line per record.
+    '''
+
+    FORMATS = ('json', 'jsonl', 'csv')
+
+    def __init__(self, format, fields, stream=None):
+        '''
+        :param list(str) fields:
+            Fields written for each record (in this order, for csv); missing fields are written as
+            null (json) or empty (csv).
+
+        :param stream:
+            File-like object where records are written; defaults to sys.stdout.
+        '''
+        assert format in self.FORMATS, 'unknown format: %r' % format
+        if stream is None:
+            stream = sys.stdout
+        self.format = format
+        self.fields = fields
+        self.stream = stream
+        self.count = 0
+        if format == 'csv':
+            self._csv_writer = csv.writer(stream, lineterminator='\n')
+            self._csv_writer.writerow(fields)
+
+    def write(self, record):
+        if self.format == 'csv':
+            row = []
+            for field in self.fields:
+                value = record.get(field)
+                if value is None:
+                    value = ''
+                elif isinstance(value, unicode):
+                    value = value.encode('utf-8')
+                row.append(value)
+            self._csv_writer.writerow(row)
+        else:
+            data = json.dumps(dict((field, record.get(field)) for field in self.fields), sort_keys=True)
+            if self.format == 'json':
+                data = (self.count == 0 and '[\n' or ',\n') + data
+            else:
+                data += '\n'
+            self.stream.write(data)
+        self.stream.flush()
+        self.count += 1
+
+    def finish(self):
+        if self.format == 'json':
+            self.stream.write(self.count == 0 and '[]\n' or '\n]\n')
+        self.stream.flush()
+
+
+#===================================================================================================
+# create_record_writer
+#===================================================================================================
+def create_record_writer(opts, fields):
+    '''
+    :return RecordWriter:
+        A writer for the format given with "--format", or None when the output is text.
+    '''
+    format = getattr(opts, 'format', 'text')
+    if format == 'text':
+        return None
+    return RecordWriter(format, fields)
+
+
 #===================================================================================================
 # check_output
 #===================================================================================================
 def check_output(*args, **kwargs):
     '''
-    Support subprocess.check_output for Python < 2.7
+    Support subprocess.check_output for Python < 2.7, reporting the process when tracing.
     '''
+    start = time.time()
+    exit_code = None
     try:
-        return subprocess.check_output(*args, **kwargs)
-    except AttributeError:
         kwargs['stdout'] = subprocess.PIPE
         popen = subprocess.Popen(*args, **kwargs)
         stdout, stderr = popen.communicate()
+        exit_code = popen.returncode
         if popen.returncode != 0:
             raise subprocess.CalledProcessError(popen.returncode, args[0])
         return stdout
+    finally:
+        trace_process(args[0], exit_code, start)
+
+#===================================================================================================
+# get_file_hash
+#===================================================================================================
+def get_file_hash(filename):
+    '''
+    :return str: the SHA-1 digest of the file contents, read in chunks.
+    '''
+    hasher = hashlib.sha1()
+    f = file(filename, 'rb')
+    try:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            hasher.update(chunk)
+    finally:
+        f.close()
+    return hasher.hexdigest()
+
+
+#===================================================================================================
+# canonicalize_xml
+#===================================================================================================
+def canonicalize_xml(xml):
+    '''
+    Returns a canonical form of a XML document, so documents that differ only in formatting (XML
+    declaration, indentation between elements, order of attributes) compare equal.
+    '''
+    import xml.etree.ElementTree as ET
+
+    root = ET.fromstring(xml)
+    iter_elements = getattr(root, 'iter', root.getiterator)  # "iter" is new in Python 2.7
+    for elem in iter_elements():
+        if elem.text is not None and not elem.text.strip():
+            elem.text = None
+        if elem.tail is not None and not elem.tail.strip():
+            elem.tail = None
+    # ElementTree writes attributes sorted by name
+    return ET.tostring(root)
+
+
+#===================================================================================================
+# get_config_fingerprint
+#===================================================================================================
+def get_config_fingerprint(config_xml):
+    '''
+    :return str:
+        A digest of the canonical form of a job configuration (see canonicalize_xml), equal for
+        configurations that differ only in formatting.
+    '''
+    with trace_phase('xml'):
+        return hashlib.sha1(canonicalize_xml(config_xml)).hexdigest()
+
+
+#===================================================================================================
+# imap_in_threads
+#===================================================================================================
+def imap_in_threads(function, items, workers):
+    '''
+    Calls `function` for each one of `items` using a bounded pool of worker threads.
+
+    :param int workers:
+        Maximum number of threads used; with 1 (or less) all items are processed in the calling
+        thread, one after the other.
+
+    :return:
+        Generates a tuple (item, result, error) for each item, in the same order as `items`, as
+        soon as it is available. Exceptions raised by `function` are not propagated: they are
+        given as `error` (which is None on success).
+    '''
+    items = list(items)
+
+    def call(item):
+        try:
+            return function(item), None
+        except Exception, e:
+            return None, e
+
+    if workers <= 1 or len(items) <= 1:
+        for item in items:
+            result, error = call(item)
+            yield item, result, error
+        return
+
+    pending = Queue.Queue()
+    for index in xrange(len(items)):
+        pending.put(index)
+
+    results = {}
+    condition = threading.Condition()
+
+    def worker():
+        while True:
+            try:
+                index = pending.get_nowait()
+            except Queue.Empty:
+                return
+            result = call(items[index])
+            with condition:
+                results[index] = result
+                condition.notify_all()
+
+    for _ in xrange(min(workers, len(items))):
+        thread = threading.Thread(target=worker)
+        thread.setDaemon(True)
+        thread.start()
+
+    for index, item in enumerate(items):
+        with condition:
+            while index not in results:
+                # waiting with a timeout keeps the main thread responsive to Ctrl+C
+                condition.wait(0.1)
+            result, error = results.pop(index)
+        yield item, result, error
+
 
 #===================================================================================================
 # main
 #===================================================================================================
 if __name__ == '__main__':
-
-#     class DumpCurrentFramesThread(threading.Thread):
-#         def run(self):
-#             while True:
-#                 import time
-#                 time.sleep(1)
-#                 import sys
-#                 stack_trace = ['---------- START Stack Trace ---------']
-#         
-#                 for _thread_id, stack in sys._current_frames().items():
-#                     stack_trace.append("\n# Thread -----------------")
-#                     for filename, lineno, name, line in traceback.extract_stack(stack):
-#                         stack_trace.append(' File "%s", line %d, in %s' % (filename, lineno, name))
-#                         if line:
-#                             stack_trace.append("   %s" % (line.strip()))
-#                 stack_trace.append('---------- END Stack Trace ---------')
-#                 print '\n'.join(stack_trace)
-#     
-#     
-#     dump_current_frames_thread = DumpCurrentFramesThread()
-#     dump_current_frames_thread.setDaemon(True)  # Will die even if this thread is alive.
-#     dump_current_frames_thread.start()
-    sys.exit(app.main())
+    try:
+        exit_code = forward_to_daemon(sys.argv[1:])
+        if exit_code is None:
+            exit_code = app.main()
+    except ConfigError, e:
+        print >> sys.stderr, 'error: %s' % e
+        exit_code = 1
+    finally:
+        stop_tracing()
+    if os.environ.get('CIT_HTTP_STATS'):
+        print_http_stats()
+    sys.exit(exit_code)
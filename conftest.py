@@ -3,12 +3,12 @@
 #===================================================================================================
 def pytest_addoption(parser):
     '''
-    Adds a new "--jenkins-available" option to pytest's command line. If not given, tests that
-    require a live Jenkins instance will be skipped.
+    Adds options to pytest's command line to run tests against a live Jenkins instance. If not
+    given, tests use a fake Jenkins server (see fake_jenkins.py).
     '''
     parser.addoption(
         "--url",
-        help="Specify URL where Jenkins that will be used on tests is running. Default is http://localhost:8080",
+        help="Specify URL where Jenkins that will be used on tests is running. Default is a fake in-process server",
     )
 
     parser.addoption(
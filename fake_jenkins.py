@@ -0,0 +1,457 @@
+'''
+In-process fake of the Jenkins HTTP API used by cit, so tests and benchmarks can run without a live
+Jenkins server.
+
+Only the endpoints used by cit are implemented: job listing, config.xml, createItem (including
+copies), doRename, doDelete, enable/disable, build, queue items, builds and their console output.
+Latency and failures can be injected, and every request is recorded so tests can check how many
+requests (and bytes) a command needs.
+
+Usage::
+
+    with FakeJenkins() as jenkins:
+        jenkins.add_job('foo')
+        client = cit.JenkinsClient(jenkins.url)
+'''
+from __future__ import with_statement
+import BaseHTTPServer
+import SocketServer
+import re
+import threading
+import time
+import urllib
+import urlparse
+
+try:
+    import json
+except ImportError:  # Python 2.5
+    import simplejson as json
+
+
+DEFAULT_CONFIG = '''<?xml version='1.0' encoding='UTF-8'?>
+<project>
+  <description></description>
+  <disabled>false</disabled>
+</project>'''
+
+RESULT_COLORS = {
+    'SUCCESS' : 'blue',
+    'UNSTABLE' : 'yellow',
+    'FAILURE' : 'red',
+    'ABORTED' : 'aborted',
+}
+
+
+#===================================================================================================
+# FakeJenkins
+#===================================================================================================
+class FakeJenkins(object):
+    '''
+    A fake Jenkins server listening on a local port, served by background threads.
+
+    Scheduled builds wait `queue_delay` seconds in the queue and then run for `build_duration`
+    seconds, finishing with the result given by `next_result` of their job (SUCCESS by default).
+
+    Authentication is not checked.
+    '''
+
+    def __init__(self, latency=0, queue_delay=0, build_duration=0):
+        '''
+        :param float latency:
+            Seconds each request takes to be answered.
+
+        :param float queue_delay:
+            Seconds a scheduled build stays in the queue.
+
+        :param float build_duration:
+            Seconds a build takes to finish.
+        '''
+        self.latency = latency
+        self.queue_delay = queue_delay
+        self.build_duration = build_duration
+        self.jobs = {}
+        self.queue_items = {}
+        self.requests = []
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.url = None
+        self._failures = []
+        self._next_queue_id = 1
+        self._lock = threading.RLock()
+        self._server = None
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def start(self):
+        self._server = _ThreadingHTTPServer(('127.0.0.1', 0), _RequestHandler)
+        self._server.fake_jenkins = self
+        self.url = 'http://127.0.0.1:%d' % self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever, kwargs={'poll_interval' : 0.05})
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def add_job(self, name, config=DEFAULT_CONFIG, builds=0, result='SUCCESS', timestamp=None):
+        '''
+        Adds a job, optionally with finished builds.
+
+        :param int builds:
+            Number of finished builds with the given `result`.
+
+        :param float timestamp:
+            Time (in seconds since the epoch) when the builds were made; defaults to now.
+        '''
+        with self._lock:
+            job = self.jobs[name] = {
+                'name' : name,
+                'config' : config,
+                'disabled' : False,
+                'builds' : [],
+                'next_result' : 'SUCCESS',
+            }
+            if timestamp is None:
+                timestamp = time.time()
+            for _ in xrange(builds):
+                build = self._start_build(job, None, timestamp)
+                build['building'] = False
+                build['result'] = result
+
+    def inject_failure(self, path_pattern='', method=None, status=500, count=1):
+        '''
+        Makes the next `count` requests whose path (with the query) matches the given regular
+        expression fail.
+
+        :param str method:
+            Only requests with this method fail; by default any.
+
+        :param int status:
+            Status of the failed responses; if None, the connection is closed without any response.
+        '''
+        with self._lock:
+            self._failures.append({
+                'regex' : re.compile(path_pattern),
+                'method' : method,
+                'status' : status,
+                'count' : count,
+            })
+
+    def reset_stats(self):
+        with self._lock:
+            self.requests = []
+            self.bytes_sent = 0
+            self.bytes_received = 0
+
+    #-----------------------------------------------------------------------------------------------
+    # request handling
+    #-----------------------------------------------------------------------------------------------
+    def handle(self, method, path, body):
+        '''
+        :return tuple(int, dict, str):
+            Status, headers and body of the response; a None status means no response at all.
+        '''
+        if self.latency:
+            time.sleep(self.latency)
+
+        with self._lock:
+            self.requests.append((method, path))
+            self.bytes_received += len(body)
+
+            for failure in self._failures:
+                if failure['count'] > 0 and failure['regex'].search(path) and \
+                    failure['method'] in (None, method):
+                    failure['count'] -= 1
+                    return failure['status'], {}, 'Injected failure'
+
+            self._update_builds()
+            parsed_url = urlparse.urlparse(path)
+            params = dict(urlparse.parse_qsl(parsed_url.query))
+            try:
+                status, headers, response_body = self._dispatch(
+                    method, urllib.unquote(parsed_url.path), params, body)
+            except KeyError:
+                status, headers, response_body = 404, {}, 'Not Found'
+            self.bytes_sent += len(response_body)
+            return status, headers, response_body
+
+    def _dispatch(self, method, path, params, body):
+        parts = [part for part in path.split('/') if part]
+
+        if parts == ['api', 'json'] and method == 'GET':
+            jobs = [self._get_job_data(job) for _, job in sorted(self.jobs.iteritems())]
+            return self._json({'jobs' : jobs}, params)
+
+        if parts == ['createItem'] and method == 'POST':
+            name = params['name']
+            if name in self.jobs:
+                return 400, {}, 'A job already exists with the name %s' % name
+            if params.get('mode') == 'copy':
+                config = self.jobs[params['from']]['config']
+            else:
+                config = body
+            self.add_job(name, config)
+            return 200, {}, ''
+
+        if len(parts) >= 3 and parts[:2] == ['queue', 'item'] and method == 'GET':
+            queue_item = self.queue_items[int(parts[2])]
+            executable = None
+            if queue_item['build'] is not None:
+                executable = {'number' : queue_item['build']['number']}
+            data = {'id' : queue_item['id'], 'cancelled' : False, 'executable' : executable}
+            return self._json(data, params)
+
+        if len(parts) < 2 or parts[0] != 'job':
+            raise KeyError(path)
+
+        job = self.jobs[parts[1]]
+        action = parts[2:]
+
+        if action == ['api', 'json'] and method == 'GET':
+            return self._json(self._get_job_data(job), params)
+
+        if action == ['config.xml']:
+            if method == 'GET':
+                return 200, {'Content-Type' : 'application/xml'}, job['config']
+            job['config'] = body
+            return 200, {}, ''
+
+        if method == 'POST' and action in (['enable'], ['disable']):
+            job['disabled'] = action == ['disable']
+            return 302, {'Location' : self._job_url(job['name'])}, ''
+
+        if method == 'POST' and action == ['doDelete']:
+            del self.jobs[job['name']]
+            return 302, {'Location' : self.url + '/'}, ''
+
+        if method == 'POST' and action == ['doRename']:
+            new_name = params['newName']
+            del self.jobs[job['name']]
+            job['name'] = new_name
+            self.jobs[new_name] = job
+            return 302, {'Location' : self._job_url(new_name)}, ''
+
+        if method == 'POST' and action == ['build']:
+            queue_id = self._next_queue_id
+            self._next_queue_id += 1
+            self.queue_items[queue_id] = {
+                'id' : queue_id, 'job' : job, 'created' : time.time(), 'build' : None}
+            return 201, {'Location' : '%s/queue/item/%d/' % (self.url, queue_id)}, ''
+
+        # builds: lastBuild or number
+        if action and method == 'GET':
+            if action[0] == 'lastBuild':
+                if not job['builds']:
+                    raise KeyError(path)
+                build = job['builds'][-1]
+            else:
+                build = job['builds'][int(action[0]) - 1]
+
+            if action[1:] == ['api', 'json']:
+                return self._json(self._get_build_data(build), params)
+            if action[1:] == ['logText', 'progressiveText']:
+                start = int(params.get('start', 0))
+                log = self._get_build_log(build)
+                headers = {'X-Text-Size' : str(len(log))}
+                if build['building']:
+                    headers['X-More-Data'] = 'true'
+                return 200, headers, log[start:]
+
+        raise KeyError(path)
+
+    def _json(self, data, params):
+        if 'tree' in params:
+            data = filter_tree(data, parse_tree(params['tree']))
+        return 200, {'Content-Type' : 'application/json'}, json.dumps(data)
+
+    def _job_url(self, name):
+        return '%s/job/%s/' % (self.url, urllib.quote(name, safe=''))
+
+    #-----------------------------------------------------------------------------------------------
+    # builds
+    #-----------------------------------------------------------------------------------------------
+    def _start_build(self, job, queue_id, timestamp):
+        build = {
+            'job' : job['name'],
+            'number' : len(job['builds']) + 1,
+            'queueId' : queue_id,
+            'timestamp' : int(timestamp * 1000),
+            'building' : True,
+            'result' : None,
+        }
+        job['builds'].append(build)
+        return build
+
+    def _update_builds(self):
+        '''
+        Starts queued builds and finishes running ones, according to the configured delays.
+        '''
+        now = time.time()
+        for queue_item in self.queue_items.itervalues():
+            job = queue_item['job']
+            if queue_item['build'] is None and now - queue_item['created'] >= self.queue_delay:
+                queue_item['build'] = self._start_build(job, queue_item['id'], now)
+        for job in self.jobs.itervalues():
+            for build in job['builds']:
+                if build['building'] and now - build['timestamp'] / 1000.0 >= self.build_duration:
+                    build['building'] = False
+                    build['result'] = job['next_result']
+
+    def _get_job_data(self, job):
+        last_build = None
+        if job['builds']:
+            last_build = self._get_build_data(job['builds'][-1])
+
+        if job['disabled']:
+            color = 'disabled'
+        else:
+            finished = [build for build in job['builds'] if not build['building']]
+            if finished:
+                color = RESULT_COLORS.get(finished[-1]['result'], 'grey')
+            else:
+                color = 'notbuilt'
+            if job['builds'] and job['builds'][-1]['building']:
+                color += '_anime'
+
+        in_queue = bool([
+            queue_item for queue_item in self.queue_items.itervalues()
+            if queue_item['job'] is job and queue_item['build'] is None
+        ])
+        return {
+            'name' : job['name'],
+            'url' : self._job_url(job['name']),
+            'color' : color,
+            'inQueue' : in_queue,
+            'lastBuild' : last_build,
+            'builds' : [self._get_build_data(build) for build in reversed(job['builds'])],
+        }
+
+    def _get_build_data(self, build):
+        return {
+            'number' : build['number'],
+            'url' : '%s%d/' % (self._job_url(build['job']), build['number']),
+            'queueId' : build['queueId'],
+            'timestamp' : build['timestamp'],
+            'building' : build['building'],
+            'result' : build['result'],
+        }
+
+    def _get_build_log(self, build):
+        log = 'Started by user cit\nBuilding in workspace /var/lib/jenkins/workspace/%s\n' % build['job']
+        if not build['building']:
+            log += 'Finished: %s\n' % build['result']
+        return log
+
+
+#===================================================================================================
+# parse_tree
+#===================================================================================================
+def parse_tree(tree):
+    '''
+    Parses the "tree" parameter of Jenkins' json api, like "jobs[name,lastBuild[number]]".
+
+    :return dict:
+        Maps each selected attribute to the selection of its own attributes (None to select
+        everything).
+    '''
+    def parse(index):
+        result = {}
+        name = ''
+        while index < len(tree):
+            char = tree[index]
+            index += 1
+            if char == '[':
+                result[name], index = parse(index)
+                name = None
+            elif char == '{':
+                # ranges ("builds[number]{0,5}") are ignored
+                index = tree.index('}', index) + 1
+            elif char in ',]':
+                if name:
+                    result[name] = None
+                name = ''
+                if char == ']':
+                    return result, index
+            elif name is not None:
+                name += char
+        if name:
+            result[name] = None
+        return result, index
+
+    return parse(0)[0]
+
+
+#===================================================================================================
+# filter_tree
+#===================================================================================================
+def filter_tree(data, selection):
+    '''
+    Filters data as Jenkins does for the given "tree" selection (see parse_tree).
+    '''
+    if selection is None or data is None:
+        return data
+    if isinstance(data, list):
+        return [filter_tree(item, selection) for item in data]
+    if isinstance(data, dict):
+        return dict(
+            (name, filter_tree(data[name], sub_selection))
+            for name, sub_selection in selection.iteritems()
+            if name in data
+        )
+    return data
+
+
+#===================================================================================================
+# _ThreadingHTTPServer
+#===================================================================================================
+class _ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+#===================================================================================================
+# _RequestHandler
+#===================================================================================================
+class _RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    # keep-alive, as Jenkins
+    protocol_version = 'HTTP/1.1'
+
+    # headers and body are sent together (otherwise each keep-alive response would be delayed by
+    # Nagle's algorithm waiting for the client's delayed ACK, distorting benchmarks)
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def _handle(self, method):
+        body = ''
+        length = int(self.headers.getheader('Content-Length') or 0)
+        if length:
+            body = self.rfile.read(length)
+
+        status, headers, response_body = self.server.fake_jenkins.handle(method, self.path, body)
+        if status is None:
+            self.close_connection = 1
+            return
+
+        self.send_response(status)
+        for name, value in headers.iteritems():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(response_body)))
+        self.end_headers()
+        self.wfile.write(response_body)
+
+    def log_message(self, format, *args):
+        pass